@@ -0,0 +1,95 @@
+import numpy as np
+from settings import max_dist, bvh_leaf_size
+
+class BVHNode:
+    def __init__(self, center, radius, children = [], primitives = []):
+        self.center = center
+        self.radius = radius
+        self.children = children
+        self.primitives = primitives
+
+def _enclosing_sphere(centers, radii):
+    center = (centers.min(axis=0) + centers.max(axis=0)) * .5
+    radius = np.max(np.linalg.norm(centers - center, axis=-1) + radii)
+    return center, radius
+
+class BoundingVolumeHierarchy:
+    # Bounding-sphere tree over the primitives of one evaluated frame. Primitives without a bound are always evaluated.
+    # kernels optionally replace each primitive's map_primitive_batch, e.g. with compiled versions.
+    def __init__(self, primitives, kernels = None):
+        self.primitives = primitives
+        self.kernels = kernels
+        self.unbounded = []
+        self.bounds = {}
+        indices = []
+        centers = []
+        radii = []
+        for i, prim in enumerate(primitives):
+            bound = prim.bounding_sphere()
+            if bound is None:
+                self.unbounded.append(i)
+            else:
+                self.bounds[i] = bound
+                indices.append(i)
+                centers.append(bound[0])
+                radii.append(bound[1])
+
+        self.root = None
+        if len(indices) > 0:
+            self.root = self._build(np.array(indices), np.array(centers, dtype=np.float64).reshape(-1, 3), np.array(radii, dtype=np.float64))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['kernels'] = None
+        return state
+
+    def _build(self, indices, centers, radii):
+        center, radius = _enclosing_sphere(centers, radii)
+        if len(indices) <= bvh_leaf_size:
+            return BVHNode(center, radius, primitives=indices.tolist())
+
+        axis = np.argmax(np.ptp(centers, axis=0))
+        order = np.argsort(centers[:, axis], kind='stable')
+        half = len(order) // 2
+        left = order[:half]
+        right = order[half:]
+        return BVHNode(center, radius, children=[
+            self._build(indices[left], centers[left], radii[left]),
+            self._build(indices[right], centers[right], radii[right])
+        ])
+
+    def map_batch(self, pos):
+        n = len(pos)
+        dist = np.full(n, max_dist * 2)
+        albedo = np.zeros((n, 3))
+        index = np.full(n, -1)
+        everything = np.arange(n)
+
+        for i in self.unbounded:
+            self._map_primitive(i, pos, everything, dist, albedo, index)
+        if self.root is not None:
+            self._traverse(self.root, pos, everything, dist, albedo, index)
+        return dist, albedo, index
+
+    def _traverse(self, node, pos, idx, dist, albedo, index):
+        # A primitive can never be closer than its bound, so skip points already closer to something else.
+        bound = np.linalg.norm(pos[idx] - node.center, axis=-1) - node.radius
+        idx = idx[bound < dist[idx]]
+        if len(idx) == 0:
+            return
+
+        for i in node.primitives:
+            center, radius = self.bounds[i]
+            sel = idx[np.linalg.norm(pos[idx] - center, axis=-1) - radius < dist[idx]]
+            if len(sel) > 0:
+                self._map_primitive(i, pos, sel, dist, albedo, index)
+        for child in node.children:
+            self._traverse(child, pos, idx, dist, albedo, index)
+
+    def _map_primitive(self, i, pos, idx, dist, albedo, index):
+        d, a = self.kernels[i](pos[idx]) if self.kernels is not None else self.primitives[i].map_primitive_batch(pos[idx])
+        lower = d < dist[idx]
+        idx = idx[lower]
+        dist[idx] = d[lower]
+        albedo[idx] = a[lower]
+        index[idx] = i
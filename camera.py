@@ -1,6 +1,7 @@
 from abc import ABCMeta, abstractmethod
 import math
 import helpers
+import numpy as np
 import settings
 from evaluator import convert_to_evaluator
 
@@ -17,18 +18,36 @@ class Camera(metaclass=ABCMeta):
     
     def generate_ray(self, x, y):
         direction = self._generate_ray(x, y)
-        return [helpers.matrix_dir_mul(self.rot_mat_inv, direction), self.pos]
+        return [helpers.matrix_dir_mul(self.rot_transform.inverse().matrix, direction), self.pos]
+
+    def generate_ray_batch(self, xs, ys):
+        directions = self._generate_ray_batch(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        directions = self.rot_transform.inverse().apply_directions(directions)
+        origins = np.broadcast_to(np.array(self.pos, dtype=np.float64), directions.shape).copy()
+        return [directions, origins]
+
+    def generate_cone_batch(self, min_xs, min_ys, max_xs, max_ys):
+        # Cones through the centre of pixel blocks [min, max), wide enough to contain every pixel footprint in the block.
+        centre = self.generate_ray_batch((min_xs + max_xs - 1) * .5, (min_ys + max_ys - 1) * .5)
+        cone_tan = np.zeros(len(centre[0]))
+        for cx, cy in [(min_xs, min_ys), (min_xs, max_ys), (max_xs, min_ys), (max_xs, max_ys)]:
+            corner = self.generate_ray_batch(cx - .5, cy - .5)[0]
+            cos = np.clip(np.sum(centre[0] * corner, axis=-1), 1e-6, 1)
+            cone_tan = np.maximum(cone_tan, np.sqrt(1 - cos * cos) / cos)
+        return [centre[0], centre[1], cone_tan]
 
     @abstractmethod
     def _generate_ray(self, x, y):
         pass
 
+    def _generate_ray_batch(self, xs, ys):
+        return np.array([self._generate_ray(x, y) for x, y in zip(xs, ys)], dtype=np.float64).reshape(-1, 3)
+
     @abstractmethod
     def evaluate(self, t):
         self.rot = self.rot_ev.evaluate(t)
         self.pos = self.pos_ev.evaluate(t)
-        self.rot_mat = helpers.matrix_rotation(self.rot)
-        self.rot_mat_inv = helpers.matrix_inv(self.rot_mat)
+        self.rot_transform = helpers.Transform.from_trs(self.rot, [0, 0, 0])
     
 class PinholeCamera(Camera):
     
@@ -41,6 +60,12 @@ class PinholeCamera(Camera):
         ry = (1 - 2 * (y + .5) / self.height) * self.scale
         
         return helpers.vec_normalize([rx, ry, -1])
+
+    def _generate_ray_batch(self, xs, ys):
+        rx = (2 * (xs + .5) / self.width - 1) * self.ar * self.scale
+        ry = (1 - 2 * (ys + .5) / self.height) * self.scale
+        directions = np.stack([rx, ry, -np.ones_like(rx)], axis=-1)
+        return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
         
     def evaluate(self, t):
         super().evaluate(t)
\ No newline at end of file
@@ -0,0 +1,81 @@
+import functools
+import numpy as np
+
+# Namespaces of generated scene modules keyed by their source, the source only changes with the scene structure.
+_compiled = {}
+
+class CompiledScene:
+    def __init__(self, namespace, params, kernel_count):
+        self.params = params
+        self.kernels = [functools.partial(namespace['prim_' + str(i)], P=params) for i in range(kernel_count)]
+        self.map_world = functools.partial(namespace['map_world'], P=params)
+
+class SceneCompiler:
+    # Collects generated NumPy code for an evaluated scene. Values whose evaluators are constant are inlined,
+    # everything that changes with t is read from the parameter list P, filled again every frame.
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+        self.params = []
+        self.counter = 0
+
+    def tmp(self, prefix = 'v'):
+        self.counter += 1
+        return prefix + str(self.counter)
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def param(self, value):
+        self.params.append(value)
+        return 'P[' + str(len(self.params) - 1) + ']'
+
+    def constant(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return repr(float(value))
+        name = self.tmp('C')
+        self.constants.append(name + ' = np.array(' + repr(np.asarray(value, dtype=np.float64).tolist()) + ')')
+        return name
+
+    def value(self, node, name):
+        # Expression for an evaluated attribute, a literal when its evaluator never changes.
+        ev = getattr(node, name + '_ev', None)
+        if ev is not None and ev.is_constant():
+            return self.constant(getattr(node, name))
+        return self.param(np.asarray(getattr(node, name), dtype=np.float64) if isinstance(getattr(node, name), list) else getattr(node, name))
+
+    def call(self, obj, method, *args):
+        # Fallback for nodes without generated code, calls their batch method on the object passed through P.
+        out = self.tmp()
+        self.emit(out + ' = ' + self.param(obj) + '.' + method + '(' + ', '.join(args) + ')')
+        return out
+
+    def function(self, name, body_lines):
+        return ['def ' + name + '(pos, P):'] + body_lines
+
+def compile_scene(primitives, pos_modifiers) -> CompiledScene:
+    # One kernel per top level primitive for the bounding volume hierarchy, plus map_world applying the
+    # solver's position modifiers before handing the points to the hierarchy passed as P[0].
+    c = SceneCompiler()
+    c.param(None)
+    source = []
+    for i, prim in enumerate(primitives):
+        c.lines = []
+        dist, albedo = prim.compile_map(c, 'pos')
+        c.emit('return ' + dist + ', ' + albedo)
+        source += c.function('prim_' + str(i), c.lines)
+
+    c.lines = []
+    pos = 'pos'
+    for m in pos_modifiers:
+        pos = m.compile_modify(c, pos)
+    c.emit('return P[0].map_batch(' + pos + ')')
+    source += c.function('map_world', c.lines)
+
+    source = '\n'.join(['import numpy as np', 'import helpers'] + c.constants + source) + '\n'
+    namespace = _compiled.get(source)
+    if namespace is None:
+        namespace = {}
+        exec(compile(source, '<compiled scene>', 'exec'), namespace)
+        _compiled[source] = namespace
+    return CompiledScene(namespace, c.params, len(primitives))
@@ -2,6 +2,8 @@ from abc import ABCMeta, abstractmethod
 from settings import max_dist, min_dist, step_number, small_step, epsilon
 import helpers
 import math
+import types
+import numpy as np
 import transitions
 from dataclasses import dataclass
 
@@ -9,15 +11,35 @@ class Evaluator(metaclass=ABCMeta):
     @abstractmethod
     def __init__(self, offset = 0):
         self.offset = offset
+        # Values baked by bake, evaluate looks them up before walking the evaluator.
+        self.track = None
         pass
         
     def evaluate(self, t) -> float:
+        if self.track is not None:
+            value = self.track.lookup(t)
+            if value is not None:
+                return value
         return self._evaluate(t + self.offset)
+
+    def evaluate_batch(self, t) -> np.ndarray:
+        return self._evaluate_batch(np.asarray(t, dtype=np.float64) + self.offset)
     
     @abstractmethod
     def _evaluate(self, t) -> float:
         pass
 
+    def _evaluate_batch(self, t) -> np.ndarray:
+        return np.array([self._evaluate(v) for v in t.tolist()], dtype=np.float64)
+
+    def bake(self, times):
+        # times must be increasing, evaluating at any of them exactly then skips the evaluator.
+        self.track = helpers.Track(times, self.evaluate_batch(times))
+
+    def is_constant(self) -> bool:
+        # True when evaluate returns the same value for every t.
+        return False
+
 class FloatEvaluator(Evaluator):
     def __init__(self, val, offset = 0):
         super().__init__(offset)
@@ -25,6 +47,12 @@ class FloatEvaluator(Evaluator):
         
     def _evaluate(self, t):
         return self.val
+
+    def _evaluate_batch(self, t):
+        return np.full(np.shape(t), self.val, dtype=np.float64)
+
+    def is_constant(self):
+        return True
     
 
 class InterpolatorEvaluator(Evaluator):
@@ -50,20 +78,45 @@ class InterpolatorEvaluator(Evaluator):
             f = 1 - f
             
         return self.val_min * (1 - f) + self.val_max * f
+
+    def _evaluate_batch(self, t):
+        f = np.where(t != 0, (t % self.interval) / self.interval, 0.0)
+        if(self.transition_function != None):
+            f = self.transition_function.transition_batch(f)
+        if self.oscilate:
+            f = np.where(t % (self.interval * 2) >= self.interval - epsilon, 1 - f, f)
+        return self.val_min * (1 - f) + self.val_max * f
         
 
 class Vector3Evaluator(metaclass=ABCMeta):
     @abstractmethod
     def __init__(self, offset = 0):
         self.offset = offset
+        self.track = None
         
     def evaluate(self, t) -> [float]:
+        if self.track is not None:
+            value = self.track.lookup(t)
+            if value is not None:
+                return list(value)
         return self._evaluate(t + self.offset)
+
+    def evaluate_batch(self, t) -> np.ndarray:
+        return self._evaluate_batch(np.asarray(t, dtype=np.float64) + self.offset)
     
     @abstractmethod
     def _evaluate(self, t) -> [float]:
         pass
 
+    def _evaluate_batch(self, t) -> np.ndarray:
+        return np.array([self._evaluate(v) for v in t.tolist()], dtype=np.float64).reshape(-1, 3)
+
+    def bake(self, times):
+        self.track = helpers.Track(times, self.evaluate_batch(times))
+
+    def is_constant(self) -> bool:
+        return False
+
 class ConstructVector3Evaluator(Vector3Evaluator):
     def __init__(self, x: Evaluator, y: Evaluator, z: Evaluator, offset = 0):
         super().__init__(offset)
@@ -78,6 +131,12 @@ class ConstructVector3Evaluator(Vector3Evaluator):
             self.z.evaluate(t)
         ]
 
+    def _evaluate_batch(self, t):
+        return np.stack([self.x.evaluate_batch(t), self.y.evaluate_batch(t), self.z.evaluate_batch(t)], axis=-1)
+
+    def is_constant(self):
+        return self.x.is_constant() and self.y.is_constant() and self.z.is_constant()
+
 
 
 class CastVector3Evaluator(Vector3Evaluator):
@@ -89,6 +148,12 @@ class CastVector3Evaluator(Vector3Evaluator):
         res = self.e.evaluate(t)
         return [res, res, res]
 
+    def _evaluate_batch(self, t):
+        return np.repeat(self.e.evaluate_batch(t)[:, None], 3, axis=-1)
+
+    def is_constant(self):
+        return self.e.is_constant()
+
 def convert_to_evaluator(f):
     if isinstance(f, int) or isinstance(f, float):
         return FloatEvaluator(f)
@@ -99,4 +164,75 @@ def convert_to_evaluator(f):
         else:
             raise Exception("Unknown length of evaluator")
     
-    return f
\ No newline at end of file
+    return f
+
+def bake_timeline(objects, times):
+    # Bakes every animated evaluator reachable from objects at times in one vectorized call each.
+    # Evaluators created or changed afterwards keep evaluating normally until baked again.
+    times = np.unique(np.asarray(times, dtype=np.float64))
+    stack = list(objects)
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (Evaluator, Vector3Evaluator)):
+            if not obj.is_constant():
+                obj.bake(times)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif hasattr(obj, '__dict__') and not isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            stack.extend(vars(obj).values())
+
+def _child_nodes(node):
+    # Scene nodes held by node, directly or in containers. Evaluators are leaves, not nodes.
+    for value in vars(node).values():
+        for v in (value if isinstance(value, (list, tuple, set, frozenset)) else [value]):
+            if hasattr(v, 'evaluate') and hasattr(v, '__dict__') and not isinstance(v, (Evaluator, Vector3Evaluator, type, types.ModuleType)):
+                yield v
+
+def is_time_dependent(node, seen = None):
+    # True when any evaluator of node or of the nodes below it is not constant.
+    seen = set() if seen is None else seen
+    seen.add(id(node))
+    for name, value in vars(node).items():
+        if name.endswith('_ev') and isinstance(value, (Evaluator, Vector3Evaluator)) and not value.is_constant():
+            return True
+    return any(is_time_dependent(c, seen) for c in _child_nodes(node) if id(c) not in seen)
+
+def evaluated_values(node, seen = None):
+    # Values evaluate assigned from the evaluators of node and the nodes below it.
+    seen = set() if seen is None else seen
+    seen.add(id(node))
+    values = [(name, getattr(node, name[:-3], None)) for name in vars(node) if name.endswith('_ev')]
+    for c in _child_nodes(node):
+        if id(c) not in seen:
+            values.append(evaluated_values(c, seen))
+    return values
+
+def _same_values(a, b):
+    try:
+        return bool(a == b)
+    except ValueError:
+        return helpers.stable_hash(a) == helpers.stable_hash(b)
+
+def update(node, t) -> bool:
+    # Evaluates node at t unless nothing below it depends on time, returns whether its version changed.
+    # Caches of derived data can compare node.changes.version instead of the values themselves.
+    tracker = vars(node).get('changes')
+    if tracker is None:
+        tracker = node.changes = helpers.ChangeTracker()
+    if tracker.time_dependent is None:
+        tracker.time_dependent = is_time_dependent(node)
+    elif not tracker.time_dependent:
+        return False
+    node.evaluate(t)
+    values = evaluated_values(node)
+    if tracker.values is not None and _same_values(values, tracker.values):
+        return False
+    tracker.values = values
+    tracker.version += 1
+    return True
@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-from settings import width, height
+from settings import width, height, print_post_stats
 from PIL import Image
 import helpers
 import numpy as np
@@ -16,20 +16,89 @@ class Film(metaclass=ABCMeta):
     @abstractmethod
     def __init__(self, post_processor: [PostProcessor]):
         self.post_processor = post_processor
+        self.shared = None
+        self.data = None
+        # Renderers with worker processes switch this on before prepare_render, single process renders stay local.
+        self.shared_memory = False
+        self.post_pool = helpers.BufferPool()
+        self.post_peak_bytes = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __hash_state__(self):
+        # Where the frame buffer lives and render statistics describe one render, not what the film produces.
+        state = self.__getstate__()
+        del state['shared_memory']
+        del state['post_peak_bytes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self.data = self.shared.array
     
     @abstractmethod
     def write_pixel(self, x, y, col):
         pass
+
+    def write_tile(self, min_x, min_y, colors):
+        # colors is indexed [x - min_x, y - min_y].
+        for x in range(len(colors)):
+            for y in range(len(colors[x])):
+                self.write_pixel(min_x + x, min_y + y, colors[x][y])
+
+    def write_pixels(self, xs, ys, colors):
+        for x, y, col in zip(xs, ys, colors):
+            self.write_pixel(x, y, col)
+
+    def blend_pixels(self, xs, ys, colors, weight):
+        # Mixes extra samples into already written pixels, going through write_pixel so films can filter them.
+        for x, y, col in zip(xs, ys, colors):
+            old = np.copy(self.data[y,x])
+            self.write_pixel(x, y, col)
+            self.data[y,x] = old * (1 - weight) + self.data[y,x] * weight
     
     def build_image(self) -> FilmReturn:
-        u = self._build_image()
+        # Post processors run in place where they can, otherwise into pooled buffers, the frame buffer is left as rendered.
+        # Each image is converted to 8 bit once, post_peak_bytes is the most memory held at once, frame buffer included.
+        pool = self.post_pool
+        pool.reset_peak()
+        raw = self._build_image(self.data)
+        processed = self.data
         for p in self.post_processor:
-            self.data = p.process_image(self.data)
-        return FilmReturn(u, self._build_image())
+            out = processed if p.in_place and processed is not self.data else pool.take(self.data.shape)
+            scratch = [pool.take(s) for s in p.scratch(self.data.shape)]
+            p.process(processed, out, scratch)
+            for s in scratch:
+                pool.give(s)
+            if processed is not self.data and processed is not out:
+                pool.give(processed)
+            processed = out
+        image = FilmReturn(raw, raw)
+        if processed is not self.data:
+            image.processed = self._build_image(processed, True)
+            pool.give(processed)
+        self.post_peak_bytes = self.data.nbytes + pool.peak
+        if print_post_stats:
+            print("Post processing peak memory: " + str(round(self.post_peak_bytes / 1024 ** 2, 2)) + " MB (" + str(round(self.post_peak_bytes / self.data.nbytes, 2)) + "x frame buffer)")
+        return image
 
-    @abstractmethod
-    def _build_image(self) -> Image.Image:
-        pass
+    def _build_image(self, data, in_place = False) -> Image.Image:
+        # Scales through one pooled float buffer, or data itself when it may be overwritten.
+        pool = self.post_pool
+        scaled = data if in_place else pool.take(data.shape)
+        np.clip(data, 0, 1, out=scaled)
+        scaled *= 255
+        formatted = pool.take(data.shape, np.uint8)
+        np.copyto(formatted, scaled, casting='unsafe')
+        image = Image.fromarray(formatted)
+        pool.give(formatted)
+        if not in_place:
+            pool.give(scaled)
+        return image
       
     @abstractmethod
     def evaluate(self, t):
@@ -37,19 +106,37 @@ class Film(metaclass=ABCMeta):
             p.evaluate(t)
     
     def prepare_render(self):
-        self.data = np.zeros((width,height,3), dtype=np.float32 )
+        # With shared_memory the frame buffer lives in shared memory so render workers can write their tiles directly.
+        if self.shared is not None and (self.shared.shm is not None) != self.shared_memory:
+            self.release()
+        if self.shared is None:
+            self.shared = helpers.SharedArray((height, width, 3), np.float32, self.shared_memory)
+        self.shared.array.fill(0)
+        self.data = self.shared.array
+
+    def release(self):
+        if self.shared is not None:
+            self.data = np.array(self.data)
+            self.shared.release()
+            self.shared = None
     
 class BasicFilm(Film):
     def __init__(self, post_processor = []):
         super().__init__(post_processor)
         
     def write_pixel(self, x, y, col):
-        self.data[x,y] = col
-    
-    def _build_image(self):
-        formatted = (np.clip(self.data, 0, 1) * 255).astype('uint8')
-        return Image.fromarray(formatted)
+        self.data[y,x] = col
+
+    def write_tile(self, min_x, min_y, colors):
+        colors = np.asarray(colors, dtype=np.float32)
+        self.data[min_y:min_y + colors.shape[1], min_x:min_x + colors.shape[0]] = colors.transpose(1, 0, 2)
+
+    def write_pixels(self, xs, ys, colors):
+        self.data[ys, xs] = np.asarray(colors, dtype=np.float32)
 
+    def blend_pixels(self, xs, ys, colors, weight):
+        self.data[ys, xs] = self.data[ys, xs] * (1 - weight) + np.asarray(colors, dtype=np.float32) * weight
+    
     def evaluate(self, t):
         super().evaluate(t)
 
@@ -57,15 +144,14 @@ class BasicFilm(Film):
 class FilteredFilm(Film):
     def __init__(self, color_filter, post_processor = []):
         super().__init__(post_processor)
-        self.data = np.zeros((width,height,3), dtype=np.float32 )
         self.color_filter = color_filter
         
     def write_pixel(self, x, y, col):
-        self.data[x,y] = self.color_filter.filter_color(x, y, col)
+        self.data[y,x] = self.color_filter.filter_color(x, y, col)
     
-    def _build_image(self):
-        formatted = (np.clip(self.data, 0, 1) * 255).astype('uint8')
-        return Image.fromarray(formatted)
-
     def evaluate(self, t):
-        super().evaluate(t)
\ No newline at end of file
+        super().evaluate(t)
+        f = self.color_filter
+        while f != None:
+            f.evaluate(t)
+            f = f.filter
\ No newline at end of file
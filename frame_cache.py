@@ -0,0 +1,66 @@
+import os
+import io
+import numpy as np
+from PIL import Image
+import helpers
+import manifest
+from film import FilmReturn
+from settings import file_path, frame_cache_size, frame_cache_digits
+
+class FrameCache:
+    # Finished frames on disk, keyed by the evaluated scene state, so frames that evaluate to the same scene
+    # (oscillating evaluators) are rendered once. Least recently used entries are evicted past max_bytes.
+    # Only the directory is shared, so pool workers can use their pickled copy concurrently.
+    def __init__(self, directory = os.path.join(file_path, 'cache'), max_bytes = frame_cache_size, digits = frame_cache_digits):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.digits = digits
+
+    def key(self, renderer):
+        # Call after renderer.evaluate(t), t itself is not part of the key.
+        return helpers.stable_hash([renderer.scene_hash(self.digits), manifest.settings_state()])
+
+    def get(self, key) -> FilmReturn:
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                img = FilmReturn(Image.fromarray(data['raw']), Image.fromarray(data['processed']))
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return img
+
+    def put(self, key, img: FilmReturn):
+        if self.max_bytes <= 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, raw=np.asarray(img.raw), processed=np.asarray(img.processed))
+        # Written under a process unique name and swapped in, readers never see a partial entry.
+        tmp = self._path(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(buffer.getbuffer())
+        os.replace(tmp, self._path(key))
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
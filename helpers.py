@@ -1,6 +1,12 @@
 import math
+import bisect
 import settings
 import os
+import enum
+import hashlib
+import subprocess
+import numpy as np
+from multiprocessing import shared_memory
 from scipy.spatial.transform import Rotation as R
 
 def vec_len_squared(vec):
@@ -153,9 +159,351 @@ def matrix_transpose(matrix):
 
     return t
 
+def rotation_matrix(vec):
+    # Closed form of matrix_rotation's x, y, z product as a 3x3 array.
+    x, y, z = np.radians(np.asarray(vec, dtype=np.float64))
+    cx, sx = math.cos(x), math.sin(x)
+    cy, sy = math.cos(y), math.sin(y)
+    cz, sz = math.cos(z), math.sin(z)
+    return np.array([
+        [cy * cz, -cy * sz, sy],
+        [sx * sy * cz + cx * sz, cx * cz - sx * sy * sz, -sx * cy],
+        [sx * sz - cx * sy * cz, cx * sy * sz + sx * cz, cx * cy]
+    ])
+
+class Transform:
+    # Affine transform as a contiguous 4x4 array in the row vector convention of the matrix helpers,
+    # points map to p @ matrix[:3, :3] + matrix[3, :3].
+    def __init__(self, matrix = None):
+        self.matrix = np.eye(4) if matrix is None else np.array(matrix, dtype=np.float64)
+        self.rotation = None
+        self.scale = None
+        self._inverse = None
+
+    @classmethod
+    def from_trs(cls, rot, pos, scale = (1, 1, 1)):
+        # Same matrix as matrix_translation, keeping rotation and scale for the closed form inverse.
+        transform = cls()
+        transform.rotation = rotation_matrix(rot)
+        transform.scale = np.array(scale, dtype=np.float64)
+        transform.matrix[:3, :3] = transform.rotation * transform.scale
+        transform.matrix[3, :3] = pos
+        return transform
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_inverse'] = None
+        return state
+
+    def inverse(self) -> 'Transform':
+        if self._inverse is None:
+            if self.rotation is not None:
+                linear = self.rotation.T / self.scale[:, None]
+            else:
+                linear = np.linalg.inv(self.matrix[:3, :3])
+            inverse = Transform()
+            inverse.matrix[:3, :3] = linear
+            inverse.matrix[3, :3] = -self.matrix[3, :3] @ linear
+            inverse._inverse = self
+            self._inverse = inverse
+        return self._inverse
+
+    def is_identity(self):
+        return np.array_equal(self.matrix, np.eye(4))
+
+    def is_translation(self):
+        return np.array_equal(self.matrix[:3, :3], np.eye(3))
+
+    def apply_points(self, points):
+        return points @ self.matrix[:3, :3] + self.matrix[3, :3]
+
+    def apply_directions(self, directions):
+        return directions @ self.matrix[:3, :3]
+
+def _col(v):
+    return v[:, None] if np.ndim(v) else v
+
+class Dual:
+    # Forward-mode derivative of an (N,) array with respect to the three input coordinates, stored as (N,3).
+    def __init__(self, v, g):
+        self.v = v
+        self.g = g
+
+    @staticmethod
+    def variables(pos):
+        eye = np.eye(3)
+        return [Dual(np.array(pos[:, i], dtype=np.float64), np.broadcast_to(eye[i], (len(pos), 3)).copy()) for i in range(3)]
+
+    @staticmethod
+    def constant(v, n):
+        return Dual(np.full(n, v, dtype=np.float64), np.zeros((n, 3)))
+
+    @staticmethod
+    def where(mask, a, b):
+        return Dual(np.where(mask, a.v, b.v), np.where(mask[:, None], a.g, b.g))
+
+    @staticmethod
+    def arctan2(y, x):
+        r2 = x.v * x.v + y.v * y.v
+        return Dual(np.arctan2(y.v, x.v), (_col(x.v) * y.g - _col(y.v) * x.g) / _col(r2))
+
+    @staticmethod
+    def _lift(o):
+        return o if isinstance(o, Dual) else Dual(o, 0.0)
+
+    def __add__(self, o):
+        o = Dual._lift(o)
+        return Dual(self.v + o.v, self.g + o.g)
+
+    __radd__ = __add__
+
+    def __sub__(self, o):
+        o = Dual._lift(o)
+        return Dual(self.v - o.v, self.g - o.g)
+
+    def __rsub__(self, o):
+        return Dual._lift(o) - self
+
+    def __neg__(self):
+        return Dual(-self.v, -self.g)
+
+    def __mul__(self, o):
+        o = Dual._lift(o)
+        return Dual(self.v * o.v, self.g * _col(o.v) + o.g * _col(self.v))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, o):
+        o = Dual._lift(o)
+        return Dual(self.v / o.v, (self.g * _col(o.v) - o.g * _col(self.v)) / _col(o.v * o.v))
+
+    def __pow__(self, p):
+        return Dual(np.power(self.v, p), self.g * _col(p * np.power(self.v, p - 1)))
+
+    def sqrt(self):
+        s = np.sqrt(self.v)
+        return Dual(s, self.g / _col(2 * s))
+
+    def log(self):
+        return Dual(np.log(self.v), self.g / _col(self.v))
+
+    def sin(self):
+        return Dual(np.sin(self.v), self.g * _col(np.cos(self.v)))
+
+    def cos(self):
+        return Dual(np.cos(self.v), -self.g * _col(np.sin(self.v)))
+
+    def arccos(self):
+        return Dual(np.arccos(self.v), -self.g / _col(np.sqrt(1 - self.v * self.v)))
+
+class SharedArray:
+    # NumPy array backed by a named shared memory block, pickles by name so pool workers attach instead of copying.
+    # With shared=False it is a plain process local array, for renders that never leave one process.
+    def __init__(self, shape, dtype = np.float32, shared = True):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.shm = None
+        self.owner = True
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape)) * self.dtype.itemsize, 1))
+            self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+        else:
+            self.array = np.zeros(self.shape, self.dtype)
+
+    def __hash_state__(self):
+        # Render buffers come and go with renders, they never identify a scene.
+        return None
+
+    def __getstate__(self):
+        if self.shm is None:
+            return {'array': self.array, 'shape': self.shape, 'dtype': self.dtype.str}
+        return {'name': self.shm.name, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.dtype = np.dtype(state['dtype'])
+        self.owner = False
+        if 'array' in state:
+            self.shm = None
+            self.array = state['array']
+            return
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    def release(self):
+        self.array = None
+        if self.shm is None:
+            return
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class Track:
+    # Values sampled at increasing times, looked up by exact time. Like shared buffers it hashes as None,
+    # a track only caches what its evaluator already defines.
+    def __init__(self, times, values):
+        self.times = np.asarray(times, dtype=np.float64).tolist()
+        self.values = np.asarray(values, dtype=np.float64).tolist()
+
+    def __hash_state__(self):
+        return None
+
+    def lookup(self, t):
+        # The value baked for t, None when t was not baked.
+        i = bisect.bisect_left(self.times, t)
+        if i < len(self.times) and self.times[i] == t:
+            return self.values[i]
+        return None
+
+class ChangeTracker:
+    # Version of a scene node's evaluated values, bumped whenever they change. Process local, it pickles
+    # fresh and hashes as None, so neither render history nor pool workers change scene hashes.
+    def __init__(self):
+        self.version = 0
+        self.values = None
+        self.time_dependent = None
+
+    def __reduce__(self):
+        return (ChangeTracker, ())
+
+    def __hash_state__(self):
+        return None
+
+class BufferPool:
+    # Scratch arrays reused across frames, keyed by shape and dtype. peak is the most bytes handed out at once
+    # since reset_peak. Process local like ChangeTracker, it pickles empty and hashes as None.
+    def __init__(self):
+        self.free = {}
+        self.in_use = 0
+        self.peak = 0
+
+    def __reduce__(self):
+        return (BufferPool, ())
+
+    def __hash_state__(self):
+        return None
+
+    def take(self, shape, dtype = np.float32):
+        free = self.free.get((tuple(shape), np.dtype(dtype).str))
+        array = free.pop() if free else np.empty(shape, dtype)
+        self.in_use += array.nbytes
+        self.peak = max(self.peak, self.in_use)
+        return array
+
+    def give(self, array):
+        self.in_use -= array.nbytes
+        self.free.setdefault((array.shape, array.dtype.str), []).append(array)
+
+    def reset_peak(self):
+        self.peak = self.in_use
+
+def frame_paths(frame):
+    return [os.path.join(settings.file_path, "img_raw" + str(frame) + ".png"), os.path.join(settings.file_path, "img" + str(frame) + ".png")]
+
+def save_frame(img, frame):
+    paths = frame_paths(frame)
+    img.raw.save(paths[0])
+    img.processed.save(paths[1])
+    return paths
+
+def stable_hash(obj, digits = None):
+    # Content hash of an object graph that is identical across processes, unlike pickle or hash() it does not
+    # depend on set iteration order or ids. Objects hash their __hash_state__() when they define it, else their pickled
+    # state, so runtime only members stay out of the hash. Objects whose __hash_state__ is None hash like None.
+    # With digits, floats are rounded to that many significant digits first and magnitudes below 10^-digits,
+    # typically rounding noise like cos(pi/2), count as zero. Integers then hash like the equal float.
+    h = hashlib.sha1()
+    _feed_hash(h, obj, set(), digits)
+    return h.hexdigest()
+
+def _round_significant(a, digits):
+    a = np.asarray(a, dtype=np.float64)
+    with np.errstate(all='ignore'):
+        scale = 10.0 ** (digits - 1 - np.floor(np.log10(np.abs(a))))
+        rounded = np.round(a * scale) / scale
+    rounded = np.where(np.isfinite(rounded), rounded, a)
+    return np.where(np.abs(a) < 10.0 ** -digits, 0.0, rounded)
+
+def _feed_hash(h, obj, stack, digits = None):
+    if isinstance(obj, (int, float)) and not isinstance(obj, bool) and digits is not None:
+        h.update(("float:" + repr(float(_round_significant(obj, digits))) + ";").encode())
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update((type(obj).__name__ + ":" + repr(obj) + ";").encode())
+    elif isinstance(obj, np.ndarray):
+        h.update(("ndarray:" + obj.dtype.str + str(obj.shape) + ";").encode())
+        if digits is not None and np.issubdtype(obj.dtype, np.floating):
+            obj = _round_significant(obj, digits).astype(obj.dtype)
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        _feed_hash(h, obj.item(), stack, digits)
+    elif isinstance(obj, (list, tuple)):
+        h.update((type(obj).__name__ + str(len(obj)) + "[").encode())
+        for o in obj:
+            _feed_hash(h, o, stack, digits)
+        h.update(b"]")
+    elif isinstance(obj, (set, frozenset)):
+        h.update(("set" + str(len(obj)) + "[").encode())
+        for o in sorted(stable_hash(o, digits) for o in obj):
+            h.update(o.encode())
+        h.update(b"]")
+    elif isinstance(obj, dict):
+        h.update(("dict" + str(len(obj)) + "{").encode())
+        for key in sorted(obj, key=repr):
+            _feed_hash(h, key, stack, digits)
+            _feed_hash(h, obj[key], stack, digits)
+        h.update(b"}")
+    elif isinstance(obj, enum.Enum):
+        h.update((type(obj).__qualname__ + "." + obj.name + ";").encode())
+    elif hasattr(obj, "__hash_state__") and obj.__hash_state__() is None:
+        _feed_hash(h, None, stack, digits)
+    elif callable(obj) and not hasattr(obj, "__dict__"):
+        h.update((getattr(obj, "__qualname__", type(obj).__qualname__) + ";").encode())
+    elif id(obj) in stack:
+        h.update(b"cycle;")
+    else:
+        stack.add(id(obj))
+        h.update((type(obj).__module__ + "." + type(obj).__qualname__ + "(").encode())
+        if hasattr(obj, "__hash_state__"):
+            state = obj.__hash_state__()
+        elif hasattr(obj, "__getstate__"):
+            state = obj.__getstate__()
+        else:
+            state = getattr(obj, "__dict__", repr(obj))
+        _feed_hash(h, state, stack, digits)
+        h.update(b")")
+        stack.discard(id(obj))
+
 def save_video():
     os.system("ffmpeg -r " + str(settings.fps) + " -i results/img%01d.png -vb 20M -vcodec mpeg4 -y results/movie.mp4")
 
+class VideoSink:
+    # Single ffmpeg process encoding raw RGB frames piped through stdin, no intermediate image files.
+    def __init__(self, path = None, fps = None, width = None, height = None):
+        self.path = os.path.join(settings.file_path, "movie.mp4") if path is None else path
+        self.width = settings.width if width is None else width
+        self.height = settings.height if height is None else height
+        fps = settings.fps if fps is None else fps
+        self.process = subprocess.Popen([
+            "ffmpeg", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", str(self.width) + "x" + str(self.height), "-r", str(fps),
+            "-i", "-", "-vb", "20M", "-vcodec", "mpeg4", "-y", self.path
+        ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def write(self, image):
+        # image is a PIL image or a (height, width, 3) uint8 array.
+        frame = np.ascontiguousarray(np.asarray(image.convert("RGB") if hasattr(image, "convert") else image, dtype=np.uint8))
+        if frame.shape != (self.height, self.width, 3):
+            raise ValueError("Frame of shape " + str(frame.shape) + " does not match the video size " + str(self.width) + "x" + str(self.height))
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        code = self.process.wait()
+        self.process = None
+        if code != 0:
+            raise RuntimeError("ffmpeg exited with code " + str(code) + " while writing " + self.path)
+
 
 
 
@@ -0,0 +1,368 @@
+import os
+import sys
+import hashlib
+import importlib.util
+import warnings
+import numpy as np
+import primitive
+import modifiers
+from settings import max_dist, min_dist, step_number, file_path, march_backend
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Scalar per point code for the built-in nodes, the JIT backend only takes scenes made entirely of these.
+_primitive_emitters = {}
+_pos_modifier_emitters = {}
+_dist_modifier_emitters = {}
+
+# Modules of generated scenes already imported by this process, keyed by the hash of their source.
+_modules = {}
+
+class _Unsupported(Exception):
+    pass
+
+def enabled(backend = march_backend):
+    if backend == 'numpy':
+        return False
+    if numba is None:
+        if backend == 'numba':
+            warnings.warn("march_backend is 'numba' but numba is not installed, using the NumPy path")
+        return False
+    return True
+
+class ScalarCompiler:
+    # Like compiler.SceneCompiler but emits scalar code for one point, positions are three variable names.
+    # Constant values become literals, everything else is a slot of the flat float parameter array P.
+    def __init__(self):
+        self.lines = []
+        self.params = []
+        self.counter = 0
+        self.indent = 1
+
+    def tmp(self, prefix = 'v'):
+        self.counter += 1
+        return prefix + str(self.counter)
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def assign(self, expr):
+        out = self.tmp()
+        self.emit(out + ' = ' + expr)
+        return out
+
+    def param(self, value):
+        self.params.append(float(value))
+        return 'P[' + str(len(self.params) - 1) + ']'
+
+    def constant(self, value):
+        return '(' + repr(float(value)) + ')'
+
+    def value(self, node, name):
+        # Scalar expression, or a list of three for vector values.
+        ev = getattr(node, name + '_ev', None)
+        value = getattr(node, name)
+        emit = self.constant if ev is not None and ev.is_constant() else self.param
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [emit(v) for v in value]
+        return emit(value)
+
+def _emit_node(c, node, pos):
+    emitter = _primitive_emitters.get(type(node))
+    if emitter is None:
+        raise _Unsupported(type(node).__name__)
+    if not isinstance(node, primitive.Primitive):
+        return emitter(c, node, pos)
+    pos = _emit_transform(c, node, pos)
+    for m in node.pos_modifiers:
+        pos = _emit_pos_modifier(c, m, pos)
+    dist, albedo = emitter(c, node, pos)
+    for m in node.dist_modifiers:
+        if type(m) not in _dist_modifier_emitters:
+            raise _Unsupported(type(m).__name__)
+        dist = _dist_modifier_emitters[type(m)](c, m, dist)
+    return dist, albedo
+
+def _emit_pos_modifier(c, m, pos):
+    if type(m) not in _pos_modifier_emitters:
+        raise _Unsupported(type(m).__name__)
+    return _pos_modifier_emitters[type(m)](c, m, pos)
+
+def _emit_transform(c, prim, pos):
+    inverse = prim.transform.inverse()
+    constant = prim.pos_ev.is_constant() and prim.rot_ev.is_constant() and prim.scale_ev.is_constant()
+    if constant and inverse.is_identity():
+        return pos
+    value = c.constant if constant else c.param
+    m = inverse.matrix
+    return [c.assign(' + '.join(pos[i] + ' * ' + value(m[i][j]) for i in range(3)) + ' + ' + value(m[3][j])) for j in range(3)]
+
+def _white(c):
+    return ['1.0', '1.0', '1.0']
+
+def _emit_sphere(c, prim, pos):
+    x, y, z = pos
+    return c.assign('np.sqrt(' + x + ' * ' + x + ' + ' + y + ' * ' + y + ' + ' + z + ' * ' + z + ') - ' + c.value(prim, 'rad')), _white(c)
+
+def _emit_box(c, prim, pos):
+    bounds = c.value(prim, 'bounds')
+    q = [c.assign('abs(' + pos[i] + ') - ' + bounds[i]) for i in range(3)]
+    outside = [c.assign('max(' + v + ', 0.0)') for v in q]
+    dist = c.assign('min(max(' + q[0] + ', max(' + q[1] + ', ' + q[2] + ')), 0.0) + np.sqrt(' + ' + '.join(o + ' * ' + o for o in outside) + ')')
+    return dist, _white(c)
+
+def _emit_torus(c, prim, pos):
+    x, y, z = pos
+    l = c.assign('np.sqrt(' + x + ' * ' + x + ' + ' + z + ' * ' + z + ') - ' + c.value(prim, 'radius'))
+    return c.assign('np.sqrt(' + l + ' * ' + l + ' + ' + y + ' * ' + y + ') - ' + c.value(prim, 'ring_diameter')), _white(c)
+
+def _emit_mandelbulb(c, prim, pos):
+    px, py, pz = pos
+    x, y, z, m, dz, t0, t1, t2, t3 = [c.tmp() for i in range(9)]
+    c.emit(x + ' = ' + px + '; ' + y + ' = ' + py + '; ' + z + ' = ' + pz)
+    c.emit(m + ' = ' + x + ' * ' + x + ' + ' + y + ' * ' + y + ' + ' + z + ' * ' + z)
+    c.emit(t0 + ' = abs(' + x + '); ' + t1 + ' = abs(' + y + '); ' + t2 + ' = abs(' + z + '); ' + t3 + ' = ' + m)
+    c.emit(dz + ' = 1.0')
+    c.emit('for i in range(5):')
+    c.indent += 1
+    for line in [
+        'm2 = M*M', 'm4 = m2*m2', 'DZ = 8.0*np.sqrt(m4*m2*M)*DZ + 1.0',
+        'x2 = X*X; x4 = x2*x2', 'y2 = Y*Y; y4 = y2*y2', 'z2 = Z*Z; z4 = z2*z2',
+        'k3 = x2 + z2', 'k2 = k3*k3*k3*k3*k3*k3*k3', 'k2 = k2**-.5',
+        'k1 = x4 + y4 + z4 - 6.0*y2*z2 - 6.0*x2*y2 + 2.0*z2*x2', 'k4 = x2 - y2 + z2',
+        'nx = PX +  64.0*X*Y*Z*(x2-z2)*k4*(x4-6.0*x2*z2+z4)*k1*k2',
+        'ny = PY + -16.0*y2*k3*k4*k4 + k1*k1',
+        'nz = PZ +  -8.0*Y*k4*(x4*x4 - 28.0*x4*x2*z2 + 70.0*x4*z4 - 28.0*x2*z2*z4 + z4*z4)*k1*k2',
+        'X = nx; Y = ny; Z = nz',
+        'T0 = min(abs(X), T0); T1 = min(abs(Y), T1); T2 = min(abs(Z), T2); T3 = min(T3, M)',
+        'M = X * X + Y * Y + Z * Z',
+        'if M > 512.0:', '    break'
+    ]:
+        for a, b in [('PX', px), ('PY', py), ('PZ', pz), ('DZ', dz), ('T0', t0), ('T1', t1), ('T2', t2), ('T3', t3), ('X', x), ('Y', y), ('Z', z), ('M', m)]:
+            line = line.replace(a, b)
+        c.emit(line)
+    c.indent -= 1
+    return c.assign('.25 * np.log(' + m + ') * np.sqrt(' + m + ') / ' + dz), [m, t1, t2]
+
+def _emit_mandelbulb2(c, prim, pos):
+    px, py, pz = pos
+    x, y, z, dr, r, it = [c.tmp() for i in range(6)]
+    power = c.value(prim, 'power')
+    c.emit(x + ' = ' + px + '; ' + y + ' = ' + py + '; ' + z + ' = ' + pz)
+    c.emit(dr + ' = 1.0; ' + r + ' = 0.0; ' + it + ' = 0.0')
+    c.emit('for i in range(15):')
+    c.indent += 1
+    for line in [
+        'IT = float(i)', 'R = np.sqrt(X * X + Y * Y + Z * Z)',
+        'if R > 2:', '    break',
+        'theta = np.arccos(Z/R)', 'phi = np.arctan2(Y, X)',
+        'DR = R**(POWER-1.0)*POWER*DR + 1.0', 'zr = R**POWER',
+        'theta = theta*POWER', 'phi = phi*POWER',
+        'X = np.sin(theta)*np.cos(phi) * zr + PX', 'Y = np.sin(phi)*np.sin(theta) * zr + PY', 'Z = np.cos(theta) * zr + PZ'
+    ]:
+        for a, b in [('POWER', power), ('PX', px), ('PY', py), ('PZ', pz), ('DR', dr), ('IT', it), ('X', x), ('Y', y), ('Z', z), ('R', r)]:
+            line = line.replace(a, b)
+        c.emit(line)
+    c.indent -= 1
+    return c.assign('0.5*np.log(' + r + ')*' + r + '/' + dr), [it, it, it]
+
+def _emit_merge(c, node, pos):
+    d1 = _emit_node(c, node.primitive1, pos)[0]
+    d2 = _emit_node(c, node.primitive2, pos)[0]
+    if(node.mode == primitive.MergeMode.Union):
+        return c.assign('min(' + d1 + ', ' + d2 + ')'), _white(c)
+    if(node.mode == primitive.MergeMode.Subtraction):
+        return c.assign('max(-' + d1 + ', ' + d2 + ')'), _white(c)
+    return c.assign('max(' + d1 + ', ' + d2 + ')'), _white(c)
+
+def _emit_smooth_merge(c, node, pos):
+    d1 = _emit_node(c, node.primitive1, pos)[0]
+    d2 = _emit_node(c, node.primitive2, pos)[0]
+    k = c.constant(node.smoothness)
+    if(node.mode == primitive.MergeMode.Union):
+        h = c.assign('min(max(.5 + .5 * (' + d2 + ' - ' + d1 + ') / ' + k + ', 0.0), 1.0)')
+        return c.assign(d2 + ' * (1 - ' + h + ') + ' + d1 + ' * ' + h + ' - ' + k + ' * ' + h + ' * (1.0 - ' + h + ')'), _white(c)
+    if(node.mode == primitive.MergeMode.Subtraction):
+        h = c.assign('min(max(.5 - .5 * (' + d2 + ' + ' + d1 + ') / ' + k + ', 0.0), 1.0)')
+        return c.assign(d2 + ' * (1 - ' + h + ') + -' + d1 + ' * ' + h + ' + ' + k + ' * ' + h + ' * (1.0 - ' + h + ')'), _white(c)
+    h = c.assign('min(max(.5 - .5 * (' + d2 + ' - ' + d1 + ') / ' + k + ', 0.0), 1.0)')
+    return c.assign(d2 + ' * (1 - ' + h + ') + ' + d1 + ' * ' + h + ' + ' + k + ' * ' + h + ' * (1.0 - ' + h + ')'), _white(c)
+
+def _emit_distort(c, m, pos):
+    if m.distortion_fac_ev.is_constant() and m.distortion_fac == 0:
+        return pos
+    freq = c.value(m, 'distortion_freq')
+    offset = c.value(m, 'distortion_offset')
+    d = c.assign(' * '.join('np.sin(' + freq + ' * ' + pos[i] + ' + ' + offset[i] + ')' for i in range(3)) + ' * ' + c.value(m, 'distortion_fac'))
+    return [c.assign(p + ' + ' + d) for p in pos]
+
+def _emit_twist(c, m, pos):
+    x, y, z = pos
+    amount = c.value(m, 'amount')
+    cos = c.assign('np.cos(' + amount + ' * ' + y + ')')
+    sin = c.assign('np.sin(' + amount + ' * ' + y + ')')
+    return [c.assign(cos + ' * ' + x + ' - ' + sin + ' * ' + z), c.assign(sin + ' * ' + x + ' + ' + cos + ' * ' + z), y]
+
+def _emit_bend(c, m, pos):
+    if m.amount_ev.is_constant() and m.amount == 0:
+        return pos
+    x, y, z = pos
+    amount = c.value(m, 'amount')
+    cos = c.assign('np.cos(' + amount + ' * ' + x + ')')
+    sin = c.assign('np.sin(' + amount + ' * ' + x + ')')
+    return [c.assign(cos + ' * ' + x + ' - ' + sin + ' * ' + y), c.assign(sin + ' * ' + x + ' + ' + cos + ' * ' + y), z]
+
+def _emit_repetition(c, m, pos):
+    period = c.value(m, 'repetition_period')
+    return [c.assign('((' + p + ' + .5 * ' + period + ') % ' + period + ') - .5 * ' + period) for p in pos]
+
+def _emit_repetition_limited(c, m, pos):
+    if m.limiter_ev.is_constant() and not np.any(m.limiter):
+        return pos
+    period = c.value(m, 'repetition_period')
+    limiter = c.value(m, 'limiter')
+    return [c.assign(pos[i] + ' - ' + period + ' * min(max(np.rint(' + pos[i] + ' / ' + period + '), -' + limiter[i] + '), ' + limiter[i] + ')') for i in range(3)]
+
+def _emit_round(c, m, dist):
+    return c.assign('abs(' + dist + ') - ' + c.value(m, 'thickness'))
+
+_primitive_emitters.update({
+    primitive.SpherePrimitive: _emit_sphere,
+    primitive.BoxPrimitive: _emit_box,
+    primitive.Torus: _emit_torus,
+    primitive.Mandelbulb: _emit_mandelbulb,
+    primitive.Mandelbulb2: _emit_mandelbulb2,
+    primitive.MergePrimitive: _emit_merge,
+    primitive.SmoothMergePrimitive: _emit_smooth_merge
+})
+_pos_modifier_emitters.update({
+    modifiers.Distort: _emit_distort,
+    modifiers.Twist: _emit_twist,
+    modifiers.Bend: _emit_bend,
+    modifiers.Repetition: _emit_repetition,
+    modifiers.RepetitionLimited: _emit_repetition_limited
+})
+_dist_modifier_emitters.update({
+    modifiers.Round: _emit_round
+})
+
+_march_source = '''
+@njit(parallel=True, cache=True)
+def march(origins, directions, start, P, omega0, hit, total, albedo, bounces, position, index, backtracks):
+    for r in prange(len(origins)):
+        dx = directions[r, 0]; dy = directions[r, 1]; dz = directions[r, 2]
+        t = start[r]
+        x = origins[r, 0] + dx * t; y = origins[r, 1] + dy * t; z = origins[r, 2] + dz * t
+        omega = omega0; prev = 0.0; step = 0.0; back_count = 0
+        bounces[r] = STEPS
+        for i in range(STEPS):
+            d, a0, a1, a2, k = map_world(x, y, z, P)
+            if omega > 1 and d + prev < step:
+                back = step - prev
+                t -= back
+                x -= dx * back; y -= dy * back; z -= dz * back
+                step = prev
+                omega = 1.0
+                back_count += 1
+                continue
+            if d < MIN_DIST:
+                hit[r] = True
+                albedo[r, 0] = a0; albedo[r, 1] = a1; albedo[r, 2] = a2
+                index[r] = k
+                bounces[r] = i
+                break
+            if d > MAX_DIST:
+                bounces[r] = i
+                break
+            step = omega * d
+            prev = d
+            t += step
+            x += dx * step; y += dy * step; z += dz * step
+        total[r] = t
+        position[r, 0] = x; position[r, 1] = y; position[r, 2] = z
+        backtracks[r] = back_count
+'''
+
+def generate_source(primitives, pos_modifiers):
+    # Source of the JIT module for an evaluated scene and its parameter array, raises _Unsupported for unknown nodes.
+    c = ScalarCompiler()
+    source = []
+    for i, prim in enumerate(primitives):
+        c.lines = []
+        dist, albedo = _emit_node(c, prim, ['x', 'y', 'z'])
+        c.emit('return ' + dist + ', ' + ', '.join(albedo))
+        source += ['@njit(cache=True)', 'def prim_' + str(i) + '(x, y, z, P):'] + c.lines
+
+    # Closest primitive as in the bounding volume hierarchy, bounds are per frame parameters.
+    c.lines = []
+    pos = ['x', 'y', 'z']
+    for m in pos_modifiers:
+        pos = _emit_pos_modifier(c, m, pos)
+    c.emit('best = ' + repr(max_dist * 2) + '; a0 = 0.0; a1 = 0.0; a2 = 0.0; index = -1')
+    for i, prim in enumerate(primitives):
+        bound = prim.bounding_sphere()
+        indent = c.indent
+        if bound is not None:
+            center = [c.param(v) for v in bound[0]]
+            c.emit('if np.sqrt(' + ' + '.join('(' + pos[k] + ' - ' + center[k] + ') ** 2' for k in range(3)) + ') - ' + c.param(bound[1]) + ' < best:')
+            c.indent += 1
+        c.emit('d, b0, b1, b2 = prim_' + str(i) + '(' + ', '.join(pos) + ', P)')
+        c.emit('if d < best:')
+        c.emit('    best = d; a0 = b0; a1 = b1; a2 = b2; index = ' + str(i))
+        c.indent = indent
+    c.emit('return best, a0, a1, a2, index')
+    source += ['@njit(cache=True)', 'def map_world(x, y, z, P):'] + c.lines
+
+    march = _march_source.replace('STEPS', str(step_number)).replace('MIN_DIST', repr(float(min_dist))).replace('MAX_DIST', repr(float(max_dist)))
+    return '\n'.join(['import numpy as np', 'from numba import njit, prange'] + source) + '\n' + march, np.array(c.params, dtype=np.float64)
+
+def _load_module(source, directory):
+    # Generated modules live in files, numba's cache=True keeps the machine code next to them for later runs and workers.
+    key = hashlib.sha1(source.encode()).hexdigest()
+    module = _modules.get(key)
+    if module is None:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'scene_' + key + '.py')
+        if not os.path.exists(path):
+            with open(path + '.' + str(os.getpid()) + '.tmp', 'w') as f:
+                f.write(source)
+            os.replace(path + '.' + str(os.getpid()) + '.tmp', path)
+        spec = importlib.util.spec_from_file_location('scene_' + key, path)
+        module = importlib.util.module_from_spec(spec)
+        # numba's cache resolves the functions' globals through the module name when loading.
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        _modules[key] = module
+    return module
+
+class JitScene:
+    def __init__(self, module, params):
+        self.module = module
+        self.params = params
+
+    def march(self, origins, directions, start_dist, over_relaxation):
+        n = len(origins)
+        hit = np.zeros(n, dtype=bool)
+        total = np.zeros(n)
+        albedo = np.zeros((n, 3))
+        bounces = np.zeros(n, dtype=np.int32)
+        position = np.zeros((n, 3))
+        index = np.full(n, -1)
+        backtracks = np.zeros(n, dtype=np.int64)
+        start = np.zeros(n) if start_dist is None else np.asarray(start_dist, dtype=np.float64)
+        self.module.march(np.ascontiguousarray(origins, dtype=np.float64).reshape(-1, 3), np.ascontiguousarray(directions, dtype=np.float64).reshape(-1, 3),
+            start, self.params, float(over_relaxation), hit, total, albedo, bounces, position, index, backtracks)
+        return hit, total, albedo, bounces, position, index, int(backtracks.sum())
+
+def compile_scene(primitives, pos_modifiers, directory = os.path.join(file_path, 'jit')) -> JitScene:
+    # None when the JIT backend is off or unavailable, or the scene uses nodes it has no code for.
+    if not enabled():
+        return None
+    try:
+        source, params = generate_source(primitives, pos_modifiers)
+    except _Unsupported:
+        return None
+    return JitScene(_load_module(source, directory), params)
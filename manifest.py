@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+import settings
+
+# Settings that only change how a render is scheduled or stored, not what the frames look like.
+_runtime_settings = [
+    'threads', 'frame_parallel', 'frames_in_flight', 'pipeline_queue_size', 'print_march_stats',
+    'video_render', 'stream_video', 'save_png_frames', 'start_frame', 'end_frame', 'still_render_t',
+    'progressive_render', 'progressive_strides', 'resume_render', 'file_path', 'frame_cache', 'frame_cache_size',
+    'bake_animation', 'print_post_stats'
+]
+
+def settings_state():
+    # Every image affecting value of the settings module, in a form that survives a json round trip.
+    state = {}
+    for name, value in sorted(vars(settings).items()):
+        if name.startswith('_') or name in _runtime_settings:
+            continue
+        try:
+            state[name] = json.loads(json.dumps(value))
+        except TypeError:
+            continue
+    return state
+
+class RenderManifest:
+    # Records which frames of an animation were finished, for which scene and settings.
+    # Frames recorded under a different scene hash or different settings are stale and dropped on load.
+    def __init__(self, scene_hash, settings_values = None, directory = settings.file_path, name = 'manifest.json'):
+        self.path = os.path.join(directory, name)
+        self.scene_hash = scene_hash
+        self.settings = settings_state() if settings_values is None else settings_values
+        self.frames = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+            if data.get('scene') == self.scene_hash and data.get('settings') == self.settings:
+                self.frames = data.get('frames', {})
+
+    def is_done(self, frame):
+        with self.lock:
+            files = self.frames.get(str(frame))
+        return files is not None and all(os.path.exists(p) for p in files)
+
+    def mark_done(self, frame, files):
+        with self.lock:
+            self.frames[str(frame)] = list(files)
+            self._write()
+
+    def _write(self):
+        # Written to a temporary file and swapped in, so a crash never leaves a truncated manifest.
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'scene': self.scene_hash, 'settings': self.settings, 'frames': self.frames}, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
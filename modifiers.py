@@ -2,6 +2,7 @@ from abc import ABCMeta, abstractmethod
 import helpers
 from evaluator import convert_to_evaluator
 import math
+import numpy as np
 
 class PosModifier(metaclass=ABCMeta):
     
@@ -12,6 +13,13 @@ class PosModifier(metaclass=ABCMeta):
     @abstractmethod
     def modify(self, pos) -> [float]:
         pass
+
+    def modify_batch(self, pos) -> np.ndarray:
+        return np.array([self.modify(p) for p in pos.tolist()], dtype=np.float64).reshape(-1, 3)
+
+    def compile_modify(self, c, pos):
+        # Emits modify_batch into the scene compiler c, returns the expression of the modified points.
+        return c.call(self, 'modify_batch', pos)
     
     @abstractmethod
     def evaluate(self, t):
@@ -27,6 +35,12 @@ class DistanceModifier(metaclass=ABCMeta):
     @abstractmethod
     def modify(self, d) -> float:
         pass
+
+    def modify_batch(self, d) -> np.ndarray:
+        return np.array([self.modify(v) for v in d.tolist()], dtype=np.float64)
+
+    def compile_modify(self, c, d):
+        return c.call(self, 'modify_batch', d)
     
     @abstractmethod
     def evaluate(self, t):
@@ -48,6 +62,21 @@ class Distort(PosModifier):
         m = math.sin(self.distortion_freq * pos[0] + self.distortion_offset[0]) * math.sin(self.distortion_freq * pos[1] + self.distortion_offset[1]) * math.sin(self.distortion_freq * pos[2] + self.distortion_offset[2]) * self.distortion_fac
         return [pos[0] + m, pos[1] + m, pos[2] + m]
 
+    def modify_batch(self, pos):
+        m = np.sin(self.distortion_freq * pos[:, 0] + self.distortion_offset[0]) * np.sin(self.distortion_freq * pos[:, 1] + self.distortion_offset[1]) * np.sin(self.distortion_freq * pos[:, 2] + self.distortion_offset[2]) * self.distortion_fac
+        return pos + m[:, None]
+
+    def compile_modify(self, c, pos):
+        if self.distortion_fac_ev.is_constant() and self.distortion_fac == 0:
+            return pos
+        freq = c.value(self, 'distortion_freq')
+        offset = c.value(self, 'distortion_offset')
+        m = c.tmp()
+        out = c.tmp()
+        c.emit(m + ' = ' + ' * '.join('np.sin(' + freq + ' * ' + pos + '[:, ' + str(i) + '] + ' + offset + '[' + str(i) + '])' for i in range(3)) + ' * ' + c.value(self, 'distortion_fac'))
+        c.emit(out + ' = ' + pos + ' + ' + m + '[:, None]')
+        return out
+
 class Twist(PosModifier):
     def __init__(self, amount):
         self.amount_ev = convert_to_evaluator(amount)
@@ -61,6 +90,22 @@ class Twist(PosModifier):
 
         return [c * pos[0] - s * pos[2], s * pos[0] + c * pos[2], pos[1]]
 
+    def modify_batch(self, pos):
+        c = np.cos(self.amount * pos[:, 1])
+        s = np.sin(self.amount * pos[:, 1])
+
+        return np.stack([c * pos[:, 0] - s * pos[:, 2], s * pos[:, 0] + c * pos[:, 2], pos[:, 1]], axis=-1)
+
+    def compile_modify(self, c, pos):
+        cos = c.tmp()
+        sin = c.tmp()
+        out = c.tmp()
+        amount = c.value(self, 'amount')
+        c.emit(cos + ' = np.cos(' + amount + ' * ' + pos + '[:, 1])')
+        c.emit(sin + ' = np.sin(' + amount + ' * ' + pos + '[:, 1])')
+        c.emit(out + ' = np.stack([' + cos + ' * ' + pos + '[:, 0] - ' + sin + ' * ' + pos + '[:, 2], ' + sin + ' * ' + pos + '[:, 0] + ' + cos + ' * ' + pos + '[:, 2], ' + pos + '[:, 1]], axis=-1)')
+        return out
+
 
 class Bend(PosModifier):
     def __init__(self, amount):
@@ -76,6 +121,24 @@ class Bend(PosModifier):
 
         return [c * pos[0] - s * pos[1], s * pos[0] + c * pos[1], pos[2]]
 
+    def modify_batch(self, pos):
+        c = np.cos(self.amount * pos[:, 0])
+        s = np.sin(self.amount * pos[:, 0])
+
+        return np.stack([c * pos[:, 0] - s * pos[:, 1], s * pos[:, 0] + c * pos[:, 1], pos[:, 2]], axis=-1)
+
+    def compile_modify(self, c, pos):
+        if self.amount_ev.is_constant() and self.amount == 0:
+            return pos
+        cos = c.tmp()
+        sin = c.tmp()
+        out = c.tmp()
+        amount = c.value(self, 'amount')
+        c.emit(cos + ' = np.cos(' + amount + ' * ' + pos + '[:, 0])')
+        c.emit(sin + ' = np.sin(' + amount + ' * ' + pos + '[:, 0])')
+        c.emit(out + ' = np.stack([' + cos + ' * ' + pos + '[:, 0] - ' + sin + ' * ' + pos + '[:, 1], ' + sin + ' * ' + pos + '[:, 0] + ' + cos + ' * ' + pos + '[:, 1], ' + pos + '[:, 2]], axis=-1)')
+        return out
+
 
 class Repetition(PosModifier):
     def __init__(self, repetition_period):
@@ -90,6 +153,16 @@ class Repetition(PosModifier):
             ((pos[1] + .5 * self.repetition_period) % self.repetition_period) - .5 * self.repetition_period,
             ((pos[2] + .5 * self.repetition_period) % self.repetition_period) - .5 * self.repetition_period
         ]
+
+    def modify_batch(self, pos):
+        return np.mod(pos + .5 * self.repetition_period, self.repetition_period) - .5 * self.repetition_period
+
+    def compile_modify(self, c, pos):
+        out = c.tmp()
+        period = c.value(self, 'repetition_period')
+        c.emit(out + ' = np.mod(' + pos + ' + .5 * ' + period + ', ' + period + ') - .5 * ' + period)
+        return out
+
 class RepetitionLimited(PosModifier):
     def __init__(self, repetition_period, limiter):
         self.repetition_period_ev = convert_to_evaluator(repetition_period)
@@ -106,6 +179,19 @@ class RepetitionLimited(PosModifier):
             (pos[2] - self.repetition_period * helpers.clamp(round(pos[2] / self.repetition_period), -self.limiter[2], self.limiter[2]))
         ]
 
+    def modify_batch(self, pos):
+        limiter = np.array(self.limiter, dtype=np.float64)
+        return pos - self.repetition_period * np.clip(np.round(pos / self.repetition_period), -limiter, limiter)
+
+    def compile_modify(self, c, pos):
+        if self.limiter_ev.is_constant() and not np.any(self.limiter):
+            return pos
+        out = c.tmp()
+        period = c.value(self, 'repetition_period')
+        limiter = c.value(self, 'limiter')
+        c.emit(out + ' = ' + pos + ' - ' + period + ' * np.clip(np.round(' + pos + ' / ' + period + '), -' + limiter + ', ' + limiter + ')')
+        return out
+
 
 class Round(DistanceModifier):
     def __init__(self, thickness):
@@ -117,6 +203,14 @@ class Round(DistanceModifier):
     def modify(self, dist):
         return abs(dist)-self.thickness
 
+    def modify_batch(self, dist):
+        return np.abs(dist) - self.thickness
+
+    def compile_modify(self, c, dist):
+        out = c.tmp()
+        c.emit(out + ' = np.abs(' + dist + ') - ' + c.value(self, 'thickness'))
+        return out
+
 
 # class Onion(DistanceModifier):
 #     def __init__(self, rad):
@@ -0,0 +1,107 @@
+import copy
+import queue
+import threading
+from collections import deque
+import helpers
+import renderer
+import manifest
+import evaluator
+import numpy as np
+from PIL import Image
+from settings import ups, pipeline_queue_size, bake_animation
+
+class AnimationPipeline:
+    # Rendering, post processing and encoding run as separate stages connected by bounded queues,
+    # so the pool marches the next frame while earlier frames are post processed and written.
+    def __init__(self, renderer: renderer.SolverRenderer, sink: helpers.VideoSink = None, save_png = False, queue_size = pipeline_queue_size, manifest: manifest.RenderManifest = None):
+        self.renderer = renderer
+        self.sink = sink
+        self.save_png = save_png
+        self.manifest = manifest
+        self.queue_size = queue_size
+        self.error = None
+
+    def run(self, frames):
+        # Yields every frame once it is rendered and handed to post processing, returns when all frames are written.
+        # The post stage owns a copy of the film, so evaluating its post processors never races the render stage.
+        # Frames the manifest reports as done are not rendered, the sink gets their saved image instead.
+        self.error = None
+        frames = list(frames)
+        done = set(f for f in frames if self.manifest is not None and self.manifest.is_done(f))
+        skipped = deque(f for f in frames if f in done)
+        todo = [f for f in frames if f not in done]
+        self.post_film = copy.copy(self.renderer.film)
+        self.post_film.shared = None
+        self.post_film = copy.deepcopy(self.post_film)
+        if bake_animation:
+            evaluator.bake_timeline([self.post_film], np.asarray(todo, dtype=np.float64) / ups)
+
+        post_queue = queue.Queue(max(self.queue_size, 1))
+        encode_queue = queue.Queue(max(self.queue_size, 1))
+        stages = [
+            threading.Thread(target=self._stage, args=(post_queue, encode_queue, self._post_process), daemon=True),
+            threading.Thread(target=self._stage, args=(encode_queue, None, self._encode), daemon=True)
+        ]
+        for stage in stages:
+            stage.start()
+
+        try:
+            for frame, item in self.renderer.render_animation(todo, post_process=False):
+                while skipped and skipped[0] < frame and self.error is None:
+                    post_queue.put((skipped[0], None))
+                    yield skipped.popleft()
+                if self.error is not None:
+                    break
+                post_queue.put((frame, item))
+                yield frame
+            while skipped and self.error is None:
+                post_queue.put((skipped[0], None))
+                yield skipped.popleft()
+        finally:
+            post_queue.put(None)
+            for stage in stages:
+                stage.join()
+        if self.error is not None:
+            raise self.error
+
+    def _stage(self, source, target, work):
+        # After a failure the stage keeps draining its queue so upstream stages never block on a full queue.
+        while True:
+            item = source.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                result = work(*item)
+            except BaseException as e:
+                self.error = e
+                continue
+            if target is not None:
+                target.put(result)
+        if target is not None:
+            target.put(None)
+
+    def _post_process(self, frame, item):
+        # Frame parallel workers and cache hits already deliver finished images, skipped frames have none.
+        if isinstance(item, renderer.RawFrame):
+            self.post_film.evaluate(frame / ups)
+            self.post_film.data = item.data
+            image = self.post_film.build_image()
+            if item.cache_key is not None:
+                self.renderer.frame_cache.put(item.cache_key, image)
+            return frame, image
+        return frame, item
+
+    def _encode(self, frame, img):
+        if img is None:
+            if self.sink is not None:
+                with Image.open(helpers.frame_paths(frame)[1]) as saved:
+                    self.sink.write(saved)
+            return
+        if self.sink is not None:
+            self.sink.write(img.processed)
+        if self.save_png:
+            paths = helpers.save_frame(img, frame)
+            if self.manifest is not None:
+                self.manifest.mark_done(frame, paths)
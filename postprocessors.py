@@ -1,5 +1,8 @@
 from abc import ABCMeta, abstractmethod
+import math
 import numpy as np
+from scipy import ndimage
+from evaluator import convert_to_evaluator
 
 # def _gaussian_kernel(l=9, sig=1.):
 #     """\
@@ -38,32 +41,68 @@ import numpy as np
 #     return output
 
 
-def _blur3x3(data):
-    kernel = np.array([[1.0,2.0,1.0], [2.0,4.0,2.0], [1.0,2.0,1.0]])
-    kernel = kernel / np.sum(kernel)
-    arraylist = []
-    for y in range(3):
-        temparray = np.copy(data)
-        temparray = np.roll(temparray, y - 1, axis=0)
-        for x in range(3):
-            temparray_X = np.copy(temparray)
-            temparray_X = np.roll(temparray_X, x - 1, axis=1)*kernel[y,x]
-            arraylist.append(temparray_X)
-
-    arraylist = np.array(arraylist)
-    arraylist_sum = np.sum(arraylist, axis=0)
-    return arraylist_sum
-
-def _cut_data(data, threshhold):
-    new_data = np.copy(data)
-    for x in range(len(data)):
-        for y in range(len(data[x])):
-            col = data[x][y]
-            if(col[0] + col[1] + col[2] < threshhold):
-                new_data[x][y] = 0
-    return new_data
+# Widest Gaussian applied at one pyramid level, wider blurs run on downsampled copies instead.
+_max_level_sigma = 2.0
+
+def _threshold(data, threshold):
+    # Pixels whose channel sum is below threshold are cut to black.
+    return data * (data.sum(axis=-1, keepdims=True) >= threshold)
+
+def _downsample(data):
+    # Averages 2x2 blocks, odd sizes repeat their last row or column.
+    h, w = data.shape[:2]
+    if h % 2 or w % 2:
+        data = np.pad(data, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    return (data[0::2, 0::2] + data[1::2, 0::2] + data[0::2, 1::2] + data[1::2, 1::2]) * .25
+
+def _axis_slice(axis, s):
+    return (slice(None),) * axis + (s,)
+
+def _upsample_axis(data, size, axis, out = None):
+    # Linear interpolation to twice the resolution keeping pixel centres aligned, cropped to size.
+    n = data.shape[axis]
+    i = np.arange(n)
+    if out is None:
+        shape = list(data.shape)
+        shape[axis] = size
+        out = np.empty(shape, data.dtype)
+    even = out[_axis_slice(axis, slice(0, None, 2))]
+    odd = out[_axis_slice(axis, slice(1, None, 2))]
+    np.multiply(data, .75, out=even)
+    even += np.take(data, np.maximum(i - 1, 0), axis) * .25
+    odd[...] = (data * .75 + np.take(data, np.minimum(i + 1, n - 1), axis) * .25)[_axis_slice(axis, slice(0, odd.shape[axis]))]
+    return out
+
+def _gaussian_blur(data, radius, out = None, scratch = None):
+    # Separable Gaussian with standard deviation radius in pixels. Wide radii blur a mip level so every pass stays
+    # a few taps wide, the variance of (4^levels - 1) / 3 pixels squared that resampling adds is taken off the Gaussian.
+    # out may be data, scratch is a spare buffer of data's shape so the full resolution passes allocate nothing.
+    out = np.empty_like(data) if out is None else out
+    levels = math.ceil(math.log2(radius / _max_level_sigma)) if radius > _max_level_sigma else 0
+    shapes = []
+    level = data
+    for _ in range(levels):
+        shapes.append(level.shape[:2])
+        level = _downsample(level)
+    sigma = math.sqrt(max(radius * abs(radius) - (4 ** levels - 1) / 3, 0)) / 2 ** levels
+    if levels == 0:
+        if sigma > 0:
+            scratch = np.empty_like(data) if scratch is None else scratch
+            ndimage.gaussian_filter1d(data, sigma, axis=0, mode='nearest', output=scratch)
+            ndimage.gaussian_filter1d(scratch, sigma, axis=1, mode='nearest', output=out)
+        elif out is not data:
+            out[...] = data
+        return out
+    if sigma > 0:
+        level = ndimage.gaussian_filter1d(level, sigma, axis=0, mode='nearest')
+        level = ndimage.gaussian_filter1d(level, sigma, axis=1, mode='nearest')
+    for shape in reversed(shapes[1:]):
+        level = _upsample_axis(_upsample_axis(level, shape[0], 0), shape[1], 1)
+    return _upsample_axis(_upsample_axis(level, shapes[0][0], 0), shapes[0][1], 1, out)
 
 class PostProcessor(metaclass=ABCMeta):
+    # Whether process may write its output over its input, the film's chain then skips the output buffer.
+    in_place = False
     
     @abstractmethod
     def __init__(self):
@@ -72,6 +111,14 @@ class PostProcessor(metaclass=ABCMeta):
     @abstractmethod
     def process_image(self, data):
         pass
+
+    def scratch(self, shape) -> [tuple]:
+        # Shapes of the float32 buffers process needs besides its input and output.
+        return []
+
+    def process(self, data, out, scratch):
+        # Writes the processed data to out, which is data itself for in place processors.
+        out[...] = self.process_image(data)
     
     @abstractmethod
     def evaluate(self, t):
@@ -79,15 +126,24 @@ class PostProcessor(metaclass=ABCMeta):
 
 
 class BloomPostProcessor(PostProcessor):
-    def __init__(self):
-        pass
+    # Adds a blurred copy of the pixels whose channel sum reaches threshold, radius is the blur's standard
+    # deviation in pixels. The default radius matches four 3x3 binomial blurs.
+    def __init__(self, threshold = .3, radius = math.sqrt(2)):
+        self.threshold_ev = convert_to_evaluator(threshold)
+        self.radius_ev = convert_to_evaluator(radius)
     
     def process_image(self, data):
-        bright = _cut_data(data, .3)
-        blur_bright = _blur3x3(_blur3x3(_blur3x3(_blur3x3(bright))))
-        
-        return np.add(data, blur_bright)
+        return data + _gaussian_blur(_threshold(data, self.threshold), self.radius)
+
+    def scratch(self, shape):
+        return [shape]
+
+    def process(self, data, out, scratch):
+        # The bright pixels are blurred inside out, so one spare buffer is all the blur needs.
+        np.multiply(data, data.sum(axis=-1, keepdims=True) >= self.threshold, out=out)
+        _gaussian_blur(out, self.radius, out, scratch[0])
+        out += data
 
-    
     def evaluate(self, t):
-        pass
\ No newline at end of file
+        self.threshold = self.threshold_ev.evaluate(t)
+        self.radius = self.radius_ev.evaluate(t)
\ No newline at end of file
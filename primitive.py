@@ -4,6 +4,10 @@ import helpers
 import math
 import numpy as np
 import modifiers
+import os
+import hashlib
+import settings
+import evaluator
 from evaluator import convert_to_evaluator
 from dataclasses import dataclass
 
@@ -20,43 +24,125 @@ class Primitive(metaclass=ABCMeta):
         self.rot_ev = convert_to_evaluator(rot)
         self.pos_ev = convert_to_evaluator(pos)
         self.scale_ev = convert_to_evaluator(scale)
+        self.bounding_radius = None
         
+    def set_bounding_radius(self, radius = None):
+        # Declares a local-space bounding radius, None derives it from the primitive.
+        self.bounding_radius = radius
+
+    def bounding_sphere(self):
+        radius = self.bounding_radius
+        if radius is None:
+            if self.pos_modifiers or self.dist_modifiers:
+                return None
+            radius = self._bounding_radius()
+            if radius is None:
+                return None
+        return np.array(self.pos, dtype=np.float64), radius * max(abs(s) for s in self.scale)
+
+    def _bounding_radius(self):
+        return None
+
     def map_primitive(self, pos) -> MapReturn:
-        pos = helpers.matrix_vec_mul(self.translation_mat_inv, pos)
+        dist, albedo = self.map_primitive_batch(np.array([pos], dtype=np.float64))
+        return MapReturn(albedo[0].tolist(), float(dist[0]))
+
+    def map_primitive_batch(self, pos) -> (np.ndarray, np.ndarray):
+        pos = self.transform.inverse().apply_points(pos)
 
         for m in self.pos_modifiers:
-            pos = m.modify(pos)
+            pos = m.modify_batch(pos)
 
-        ret = self._map_primitive(pos)
+        dist, albedo = self._map_primitive_batch(pos)
         for d in self.dist_modifiers:
-            ret.distance = d.modify(distance)
-        return ret
+            dist = d.modify_batch(dist)
+        return dist, albedo
     
-    @abstractmethod
+    def compile_map(self, c, pos):
+        # Emits map_primitive_batch into the scene compiler c, returns the (dist, albedo) expressions.
+        pos = self._compile_transform(c, pos)
+        for m in self.pos_modifiers:
+            pos = m.compile_modify(c, pos)
+        dist, albedo = self._compile_kernel(c, pos)
+        for d in self.dist_modifiers:
+            dist = d.compile_modify(c, dist)
+        return dist, albedo
+
+    def _compile_transform(self, c, pos):
+        inverse = self.transform.inverse()
+        constant = self.pos_ev.is_constant() and self.rot_ev.is_constant() and self.scale_ev.is_constant()
+        if constant and inverse.is_identity():
+            return pos
+        value = c.constant if constant else c.param
+        out = c.tmp()
+        if constant and inverse.is_translation():
+            c.emit(out + ' = ' + pos + ' + ' + value(inverse.matrix[3, :3]))
+        else:
+            c.emit(out + ' = ' + pos + ' @ ' + value(inverse.matrix[:3, :3]) + ' + ' + value(inverse.matrix[3, :3]))
+        return out
+
+    def _compile_kernel(self, c, pos):
+        res = c.call(self, '_map_primitive_batch', pos)
+        return res + '[0]', res + '[1]'
+
+    def gradient_batch(self, pos):
+        # Analytic SDF gradient in world space, None when the primitive or its modifiers have no closed form.
+        if self.pos_modifiers or self.dist_modifiers:
+            return None
+        inverse = self.transform.inverse()
+        gradient = self._gradient_batch(inverse.apply_points(pos))
+        if gradient is None:
+            return None
+        return gradient @ inverse.matrix[:3, :3].T
+
+    def _gradient_batch(self, pos):
+        return None
+
     def _map_primitive(self, pos) -> MapReturn:
-        pass
+        dist, albedo = self._map_primitive_batch(np.array([pos], dtype=np.float64))
+        return MapReturn(albedo[0].tolist(), float(dist[0]))
+
+    def _map_primitive_batch(self, pos) -> (np.ndarray, np.ndarray):
+        # Subclasses implement one of the two, each default is written in terms of the other.
+        if type(self)._map_primitive is Primitive._map_primitive:
+            raise NotImplementedError(type(self).__name__ + " implements neither _map_primitive nor _map_primitive_batch")
+        res = [self._map_primitive(p) for p in pos.tolist()]
+        return np.array([r.distance for r in res], dtype=np.float64), np.array([r.albedo for r in res], dtype=np.float64).reshape(-1, 3)
     
     @abstractmethod
     def evaluate(self, t):
         self.rot = self.rot_ev.evaluate(t)
         self.pos = self.pos_ev.evaluate(t)
         self.scale = self.scale_ev.evaluate(t)
-        self.translation_mat = helpers.matrix_translation(self.rot, self.pos, self.scale)
-        self.translation_mat_inv = helpers.matrix_inv(self.translation_mat)
+        self.transform = helpers.Transform.from_trs(self.rot, self.pos, self.scale)
         for m in self.pos_modifiers:
             m.evaluate(t)
         for m in self.dist_modifiers:
             m.evaluate(t)
 
+def _white_albedo(n):
+    return np.ones((n, 3))
+
 class SpherePrimitive(Primitive):
     def __init__(self, pos, rad, rot = [0, 0, 0], scale=[1, 1, 1], pos_modifiers = [], dist_modifiers = []):
         super().__init__(pos, rot, scale, pos_modifiers, dist_modifiers)
         self.rad_ev = convert_to_evaluator(rad)
         pass
 
-    def _map_primitive(self, pos):
-        dist = helpers.vec_len(pos) - self.rad
-        return MapReturn([1,1,1], dist)
+    def _map_primitive_batch(self, pos):
+        dist = np.linalg.norm(pos, axis=-1) - self.rad
+        return dist, _white_albedo(len(pos))
+
+    def _bounding_radius(self):
+        return abs(self.rad)
+
+    def _compile_kernel(self, c, pos):
+        dist = c.tmp()
+        c.emit(dist + ' = np.linalg.norm(' + pos + ', axis=-1) - ' + c.value(self, 'rad'))
+        return dist, 'np.ones((len(' + pos + '), 3))'
+
+    def _gradient_batch(self, pos):
+        return pos / np.linalg.norm(pos, axis=-1, keepdims=True)
     
     def evaluate(self, t):
         super().evaluate(t)
@@ -68,10 +154,28 @@ class BoxPrimitive(Primitive):
         super().__init__(pos, rot, [1, 1, 1], pos_modifiers, dist_modifiers)
         self.bounds_ev = convert_to_evaluator(bounds)
 
-    def _map_primitive(self, pos):
-        dist_vec = [abs(pos[0]) - self.bounds[0], abs(pos[1]) - self.bounds[1], abs(pos[2]) - self.bounds[2]]
-        dist =  min(max(dist_vec[0],max(dist_vec[1], dist_vec[2])), 0.0) + helpers.vec_len(helpers.vec_max(dist_vec, 0))
-        return MapReturn([1,1,1], dist)
+    def _map_primitive_batch(self, pos):
+        dist_vec = np.abs(pos) - np.array(self.bounds, dtype=np.float64)
+        dist = np.minimum(np.max(dist_vec, axis=-1), 0.0) + np.linalg.norm(np.maximum(dist_vec, 0), axis=-1)
+        return dist, _white_albedo(len(pos))
+
+    def _bounding_radius(self):
+        return helpers.vec_len(self.bounds)
+
+    def _compile_kernel(self, c, pos):
+        dist_vec = c.tmp()
+        dist = c.tmp()
+        c.emit(dist_vec + ' = np.abs(' + pos + ') - ' + c.value(self, 'bounds'))
+        c.emit(dist + ' = np.minimum(np.max(' + dist_vec + ', axis=-1), 0.0) + np.linalg.norm(np.maximum(' + dist_vec + ', 0), axis=-1)')
+        return dist, 'np.ones((len(' + pos + '), 3))'
+
+    def _gradient_batch(self, pos):
+        dist_vec = np.abs(pos) - np.array(self.bounds, dtype=np.float64)
+        outside = np.maximum(dist_vec, 0)
+        outside = outside / np.maximum(np.linalg.norm(outside, axis=-1, keepdims=True), 1e-12)
+        inside = np.zeros_like(pos)
+        inside[np.arange(len(pos)), np.argmax(dist_vec, axis=-1)] = 1
+        return np.sign(pos) * np.where(np.max(dist_vec, axis=-1)[:, None] > 0, outside, inside)
 
     def evaluate(self, t):
         super().evaluate(t)
@@ -83,10 +187,27 @@ class Torus(Primitive):
         self.radius_ev = convert_to_evaluator(radius)
         self.ring_diameter_ev = convert_to_evaluator(ring_diameter)
 
-    def _map_primitive(self, pos):
-        l = math.sqrt(pos[0] * pos[0] + pos[2] * pos[2]) - self.radius
-        dist =  math.sqrt(l * l + pos[1] * pos[1]) - self.ring_diameter
-        return MapReturn([1,1,1], dist)
+    def _map_primitive_batch(self, pos):
+        l = np.sqrt(pos[:, 0] * pos[:, 0] + pos[:, 2] * pos[:, 2]) - self.radius
+        dist = np.sqrt(l * l + pos[:, 1] * pos[:, 1]) - self.ring_diameter
+        return dist, _white_albedo(len(pos))
+
+    def _bounding_radius(self):
+        return abs(self.radius) + abs(self.ring_diameter)
+
+    def _compile_kernel(self, c, pos):
+        l = c.tmp()
+        dist = c.tmp()
+        c.emit(l + ' = np.sqrt(' + pos + '[:, 0] * ' + pos + '[:, 0] + ' + pos + '[:, 2] * ' + pos + '[:, 2]) - ' + c.value(self, 'radius'))
+        c.emit(dist + ' = np.sqrt(' + l + ' * ' + l + ' + ' + pos + '[:, 1] * ' + pos + '[:, 1]) - ' + c.value(self, 'ring_diameter'))
+        return dist, 'np.ones((len(' + pos + '), 3))'
+
+    def _gradient_batch(self, pos):
+        xz = np.sqrt(pos[:, 0] * pos[:, 0] + pos[:, 2] * pos[:, 2])
+        l = xz - self.radius
+        q = np.sqrt(l * l + pos[:, 1] * pos[:, 1])
+        l = l / (np.maximum(xz, 1e-12) * q)
+        return np.stack([pos[:, 0] * l, pos[:, 1] / q, pos[:, 2] * l], axis=-1)
 
     def evaluate(self, t):
         super().evaluate(t)
@@ -99,6 +220,30 @@ class MergeMode(Enum):
     Subtraction = 2,
     Intersection = 3
 
+def _merge_bounding_sphere(b1, b2, mode, padding):
+    if(mode == MergeMode.Subtraction):
+        if b2 is None:
+            return None
+        return b2[0], b2[1] + padding
+
+    if(mode == MergeMode.Intersection):
+        candidates = [b for b in [b1, b2] if b is not None]
+        if len(candidates) == 0:
+            return None
+        b = min(candidates, key=lambda b: b[1])
+        return b[0], b[1] + padding
+
+    if b1 is None or b2 is None:
+        return None
+    offset = helpers.vec_len(b2[0] - b1[0])
+    if offset + b2[1] <= b1[1]:
+        return b1[0], b1[1] + padding
+    if offset + b1[1] <= b2[1]:
+        return b2[0], b2[1] + padding
+    radius = (offset + b1[1] + b2[1]) * .5
+    center = b1[0] + (b2[0] - b1[0]) * ((radius - b1[1]) / offset)
+    return center, radius + padding
+
 class MergePrimitive():
     def __init__(self, primitive1: Primitive, primitive2: Primitive, mode: MergeMode):
         self.primitive1 = primitive1
@@ -106,19 +251,38 @@ class MergePrimitive():
         self.mode = mode
 
     def map_primitive(self, pos):
-        d1 = self.primitive1.map_primitive(pos)
-        d2 = self.primitive2.map_primitive(pos)
+        dist, albedo = self.map_primitive_batch(np.array([pos], dtype=np.float64))
+        return MapReturn(albedo[0].tolist(), float(dist[0]))
+
+    def map_primitive_batch(self, pos):
+        d1 = self.primitive1.map_primitive_batch(pos)[0]
+        d2 = self.primitive2.map_primitive_batch(pos)[0]
         
         if(self.mode == MergeMode.Union):
-            dist = min(d1.distance, d2.distance)
-            return MapReturn([1,1,1], dist)
+            return np.minimum(d1, d2), _white_albedo(len(pos))
 
         if(self.mode == MergeMode.Subtraction):
-            dist =  max(-d1.distance, d2.distance)
-            return MapReturn([1,1,1], dist)
+            return np.maximum(-d1, d2), _white_albedo(len(pos))
+
+        return np.maximum(d1, d2), _white_albedo(len(pos))
+
+    def compile_map(self, c, pos):
+        d1 = self.primitive1.compile_map(c, pos)[0]
+        d2 = self.primitive2.compile_map(c, pos)[0]
+        dist = c.tmp()
+        if(self.mode == MergeMode.Union):
+            c.emit(dist + ' = np.minimum(' + d1 + ', ' + d2 + ')')
+        elif(self.mode == MergeMode.Subtraction):
+            c.emit(dist + ' = np.maximum(-' + d1 + ', ' + d2 + ')')
+        else:
+            c.emit(dist + ' = np.maximum(' + d1 + ', ' + d2 + ')')
+        return dist, 'np.ones((len(' + pos + '), 3))'
 
-        dist =  max(d1.distance, d2.distance)
-        return MapReturn([1,1,1], dist)
+    def gradient_batch(self, pos):
+        return None
+
+    def bounding_sphere(self):
+        return _merge_bounding_sphere(self.primitive1.bounding_sphere(), self.primitive2.bounding_sphere(), self.mode, 0)
 
     def evaluate(self, t):
         self.primitive1.evaluate(t)
@@ -132,21 +296,48 @@ class SmoothMergePrimitive():
         self.smoothness = smoothness
 
     def map_primitive(self, pos): 
-        d1 = self.primitive1.map_primitive(pos)
-        d2 = self.primitive2.map_primitive(pos)
+        dist, albedo = self.map_primitive_batch(np.array([pos], dtype=np.float64))
+        return MapReturn(albedo[0].tolist(), float(dist[0]))
+
+    def map_primitive_batch(self, pos):
+        d1 = self.primitive1.map_primitive_batch(pos)[0]
+        d2 = self.primitive2.map_primitive_batch(pos)[0]
         if(self.mode == MergeMode.Union):
-            h = helpers.clamp(.5 + .5 * (d2 - d1) / self.smoothness, 0, 1)
+            h = np.clip(.5 + .5 * (d2 - d1) / self.smoothness, 0, 1)
             dist = helpers.interpolate(d2, d1, h) - self.smoothness * h * (1.0 - h)
-            return MapReturn([1,1,1], dist)
+            return dist, _white_albedo(len(pos))
 
         if(self.mode == MergeMode.Subtraction):
-            h = helpers.clamp(.5 - .5 * (d2 + d1) / self.smoothness, 0, 1)
+            h = np.clip(.5 - .5 * (d2 + d1) / self.smoothness, 0, 1)
             dist = helpers.interpolate(d2, -d1, h) + self.smoothness * h * (1.0 - h)
-            return MapReturn([1,1,1], dist)
+            return dist, _white_albedo(len(pos))
         
-        h = helpers.clamp(.5 - .5 * (d2 - d1) / self.smoothness, 0, 1)
+        h = np.clip(.5 - .5 * (d2 - d1) / self.smoothness, 0, 1)
         dist = helpers.interpolate(d2, d1, h) + self.smoothness * h * (1.0 - h)
-        return MapReturn([1,1,1], dist)
+        return dist, _white_albedo(len(pos))
+
+    def compile_map(self, c, pos):
+        d1 = self.primitive1.compile_map(c, pos)[0]
+        d2 = self.primitive2.compile_map(c, pos)[0]
+        k = c.constant(self.smoothness)
+        h = c.tmp()
+        dist = c.tmp()
+        if(self.mode == MergeMode.Union):
+            c.emit(h + ' = np.clip(.5 + .5 * (' + d2 + ' - ' + d1 + ') / ' + k + ', 0, 1)')
+            c.emit(dist + ' = helpers.interpolate(' + d2 + ', ' + d1 + ', ' + h + ') - ' + k + ' * ' + h + ' * (1.0 - ' + h + ')')
+        elif(self.mode == MergeMode.Subtraction):
+            c.emit(h + ' = np.clip(.5 - .5 * (' + d2 + ' + ' + d1 + ') / ' + k + ', 0, 1)')
+            c.emit(dist + ' = helpers.interpolate(' + d2 + ', -' + d1 + ', ' + h + ') + ' + k + ' * ' + h + ' * (1.0 - ' + h + ')')
+        else:
+            c.emit(h + ' = np.clip(.5 - .5 * (' + d2 + ' - ' + d1 + ') / ' + k + ', 0, 1)')
+            c.emit(dist + ' = helpers.interpolate(' + d2 + ', ' + d1 + ', ' + h + ') + ' + k + ' * ' + h + ' * (1.0 - ' + h + ')')
+        return dist, 'np.ones((len(' + pos + '), 3))'
+
+    def gradient_batch(self, pos):
+        return None
+
+    def bounding_sphere(self):
+        return _merge_bounding_sphere(self.primitive1.bounding_sphere(), self.primitive2.bounding_sphere(), self.mode, abs(self.smoothness))
 
     def evaluate(self, t):
         self.primitive1.evaluate(t)
@@ -156,54 +347,87 @@ class Mandelbulb(Primitive):
     def __init__(self, pos, rot = [0, 0, 0], pos_modifiers = [], dist_modifiers = []):
         super().__init__(pos, rot, [1, 1, 1], pos_modifiers, dist_modifiers)
 
-    def _map_primitive(self, pos):
-        w = [pos[0], pos[1], pos[2]]
-        m = helpers.vec_len_squared(w)
+    def _map_primitive_batch(self, pos):
+        w = np.array(pos, dtype=np.float64)
+        m = np.sum(w * w, axis=-1)
 
-        trap = [abs(w[0]), abs(w[1]), abs(w[2]), m]
-        dz = 1.0
-        
-        for i in range(5):
-            # dz = 8.0 * math.pow(m, 3.5) * dz + 1.0
-
-            # r = helpers.vec_len(w)
-            # b = 8.0 * math.acos(w[1] / r)
-            # a = 8.0 * math.atan2(w[0], w[2])
-            # w = [
-            #     pos[0] + pow(r, 8.0) * math.sin(b) * math.sin(a),
-            #     pos[1] + pow(r, 8.0) * math.cos(b),
-            #     pos[2] + pow(r, 8.0) * math.sin(b) * math.cos(a),
-            # ]
-
-            m2 = m*m;
-            m4 = m2*m2;
-            dz = 8.0*math.sqrt(m4*m2*m)*dz + 1.0;
-
-            x = w[0]; x2 = x*x; x4 = x2*x2;
-            y = w[1]; y2 = y*y; y4 = y2*y2;
-            z = w[2]; z2 = z*z; z4 = z2*z2;
-
-            k3 = x2 + z2;
-            k2 = k3*k3*k3*k3*k3*k3*k3;
-            k2 = k2**-.5
-            k1 = x4 + y4 + z4 - 6.0*y2*z2 - 6.0*x2*y2 + 2.0*z2*x2;
-            k4 = x2 - y2 + z2;
-
-            w[0] = pos[0] +  64.0*x*y*z*(x2-z2)*k4*(x4-6.0*x2*z2+z4)*k1*k2;
-            w[1] = pos[1] + -16.0*y2*k3*k4*k4 + k1*k1;
-            w[2] = pos[2] +  -8.0*y*k4*(x4*x4 - 28.0*x4*x2*z2 + 70.0*x4*z4 - 28.0*x2*z2*z4 + z4*z4)*k1*k2;
+        trap = np.concatenate([np.abs(w), m[:, None]], axis=-1)
+        dz = np.ones(len(pos))
 
-            trap = [min(abs(w[0]), trap[0]), min(abs(w[1]), trap[1]), min(abs(w[2]), trap[2]), min(trap[3], m)]
-            m = helpers.vec_len_squared(w)
-            if m > 512.0:
+        # Points whose orbit has not escaped yet, mirrors the early break of the scalar loop.
+        active = np.arange(len(pos))
+        for i in range(5):
+            if len(active) == 0:
                 break
+            p = pos[active]
+            ma = m[active]
 
+            m2 = ma*ma
+            m4 = m2*m2
+            dz[active] = 8.0*np.sqrt(m4*m2*ma)*dz[active] + 1.0
 
-            
-        return MapReturn([m, trap[1], trap[2]], .25 * math.log(m) * math.sqrt(m) / dz)
+            x = w[active, 0]; x2 = x*x; x4 = x2*x2
+            y = w[active, 1]; y2 = y*y; y4 = y2*y2
+            z = w[active, 2]; z2 = z*z; z4 = z2*z2
 
+            k3 = x2 + z2
+            k2 = k3*k3*k3*k3*k3*k3*k3
+            k2 = k2**-.5
+            k1 = x4 + y4 + z4 - 6.0*y2*z2 - 6.0*x2*y2 + 2.0*z2*x2
+            k4 = x2 - y2 + z2
+
+            wa = np.stack([
+                p[:, 0] +  64.0*x*y*z*(x2-z2)*k4*(x4-6.0*x2*z2+z4)*k1*k2,
+                p[:, 1] + -16.0*y2*k3*k4*k4 + k1*k1,
+                p[:, 2] +  -8.0*y*k4*(x4*x4 - 28.0*x4*x2*z2 + 70.0*x4*z4 - 28.0*x2*z2*z4 + z4*z4)*k1*k2,
+            ], axis=-1)
+            w[active] = wa
+
+            trap[active, :3] = np.minimum(np.abs(wa), trap[active, :3])
+            trap[active, 3] = np.minimum(trap[active, 3], ma)
+            m[active] = np.sum(wa * wa, axis=-1)
+            active = active[m[active] <= 512.0]
+
+        albedo = np.stack([m, trap[:, 1], trap[:, 2]], axis=-1)
+        return .25 * np.log(m) * np.sqrt(m) / dz, albedo
+
+    def _bounding_radius(self):
+        return 1.5
+
+    def _gradient_batch(self, pos):
+        # Same iteration as _map_primitive_batch on dual numbers, yields the exact gradient of the distance estimate.
+        c = helpers.Dual.variables(pos)
+        w = list(c)
+        m = w[0]*w[0] + w[1]*w[1] + w[2]*w[2]
+        dz = helpers.Dual.constant(1.0, len(pos))
+        active = np.ones(len(pos), dtype=bool)
+        for i in range(5):
+            m2 = m*m
+            m4 = m2*m2
+            new_dz = 8.0*(m4*m2*m).sqrt()*dz + 1.0
+
+            x = w[0]; x2 = x*x; x4 = x2*x2
+            y = w[1]; y2 = y*y; y4 = y2*y2
+            z = w[2]; z2 = z*z; z4 = z2*z2
+
+            k3 = x2 + z2
+            k2 = k3**-3.5
+            k1 = x4 + y4 + z4 - 6.0*y2*z2 - 6.0*x2*y2 + 2.0*z2*x2
+            k4 = x2 - y2 + z2
+
+            new_w = [
+                c[0] +  64.0*x*y*z*(x2-z2)*k4*(x4-6.0*x2*z2+z4)*k1*k2,
+                c[1] + -16.0*y2*k3*k4*k4 + k1*k1,
+                c[2] +  -8.0*y*k4*(x4*x4 - 28.0*x4*x2*z2 + 70.0*x4*z4 - 28.0*x2*z2*z4 + z4*z4)*k1*k2,
+            ]
+            dz = helpers.Dual.where(active, new_dz, dz)
+            w = [helpers.Dual.where(active, new_w[k], w[k]) for k in range(3)]
+            m = w[0]*w[0] + w[1]*w[1] + w[2]*w[2]
+            active &= m.v <= 512.0
+            if not active.any():
+                break
 
-        # return 
+        return (.25 * m.log() * m.sqrt() / dz).g
 
     def evaluate(self, t):
         super().evaluate(t)
@@ -213,38 +437,165 @@ class Mandelbulb2(Primitive):
         super().__init__(pos, rot, [1, 1, 1], pos_modifiers, dist_modifiers)
         self.power_ev = convert_to_evaluator(power)
 
-    def _map_primitive(self, pos):
-        z = [pos[0], pos[1], pos[2]]
-        dr = 1.0;
-        r = 0.0;
-        iterations = 0;
+    def _map_primitive_batch(self, pos):
+        z = np.array(pos, dtype=np.float64)
+        dr = np.ones(len(pos))
+        r = np.zeros(len(pos))
+        iterations = np.zeros(len(pos))
 
+        # Points that have not escaped the bailout radius yet.
+        active = np.arange(len(pos))
         for i in range(15):
-            iterations = i;
-            r = helpers.vec_len(z)
+            iterations[active] = i
+            za = z[active]
+            ra = np.linalg.norm(za, axis=-1)
+            r[active] = ra
+
+            inside = ra <= 2
+            active = active[inside]
+            if len(active) == 0:
+                break
+            za = za[inside]
+            ra = ra[inside]
+
+            theta = np.arccos(za[:, 2]/ra)
+            phi = np.arctan2(za[:, 1], za[:, 0])
+            dr[active] = np.power(ra, self.power-1.0)*self.power*dr[active] + 1.0
+
+            zr = np.power(ra, self.power)
+            theta = theta*self.power
+            phi = phi*self.power
+
+            z[active] = np.stack([np.sin(theta)*np.cos(phi) * zr, np.sin(phi)*np.sin(theta) * zr, np.cos(theta) * zr], axis=-1) + pos[active]
+        dst = 0.5*np.log(r)*r/dr
+        return dst, np.repeat(iterations[:, None], 3, axis=-1)
+
+    def _bounding_radius(self):
+        # Orbits starting outside the bailout radius escape immediately.
+        return 2.0
+
+    def _gradient_batch(self, pos):
+        # Same iteration as _map_primitive_batch on dual numbers, yields the exact gradient of the distance estimate.
+        c = helpers.Dual.variables(pos)
+        z = list(c)
+        dr = helpers.Dual.constant(1.0, len(pos))
+        r = helpers.Dual.constant(0.0, len(pos))
+        active = np.ones(len(pos), dtype=bool)
+        for i in range(15):
+            r_new = (z[0]*z[0] + z[1]*z[1] + z[2]*z[2]).sqrt()
+            r = helpers.Dual.where(active, r_new, r)
+            active &= r_new.v <= 2
+            if not active.any():
+                break
 
-            if (r>2):
-                break;
-            
-            theta = math.acos(z[2]/r);
-            phi = math.atan2(z[1],z[0]);
-            dr =  math.pow( r, self.power-1.0)*self.power*dr + 1.0;
+            theta = (z[2]/r_new).arccos()*self.power
+            phi = helpers.Dual.arctan2(z[1], z[0])*self.power
+            dr = helpers.Dual.where(active, r_new**(self.power-1.0)*self.power*dr + 1.0, dr)
 
-            zr = math.pow( r,self.power);
-            theta = theta*self.power;
-            phi = phi*self.power;
-            
-            z = [math.sin(theta)*math.cos(phi) * zr, math.sin(phi)*math.sin(theta) * zr, math.cos(theta) * zr];
-            z = [z[0] + pos[0], z[1] + pos[1], z[2] + pos[2]];
-        dst = 0.5*math.log(r)*r/dr;
-        return MapReturn([iterations, iterations, iterations], dst);
+            zr = r_new**self.power
+            new_z = [theta.sin()*phi.cos()*zr + c[0], phi.sin()*theta.sin()*zr + c[1], theta.cos()*zr + c[2]]
+            z = [helpers.Dual.where(active, new_z[k], z[k]) for k in range(3)]
+        return (0.5*r.log()*r/dr).g
 
+    def evaluate(self, t):
+        super().evaluate(t)
+        self.power = self.power_ev.evaluate(t)
 
-        # return 
+def _local_parameters(prim):
+    # Evaluated values of everything except the transform, these are what a baked grid depends on.
+    names = sorted(n for n in vars(prim) if n.endswith('_ev') and n not in ('pos_ev', 'rot_ev', 'scale_ev'))
+    return [type(prim).__name__] + [[n[:-3], getattr(prim, n[:-3])] for n in names]
+
+def bake_distance_field(prim: Primitive, path, resolution = 128, radius = None):
+    # Samples the local-space SDF of an evaluated primitive on a resolution^3 grid spanning [-radius, radius].
+    if radius is None:
+        radius = prim._bounding_radius()
+    axis = np.linspace(-radius, radius, resolution)
+    # Written under a process unique name and swapped in, workers baking the same key never share a file.
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    grid = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(resolution, resolution, resolution))
+    ys, zs = np.meshgrid(axis, axis, indexing='ij')
+    for i in range(resolution):
+        pos = np.stack([np.full(ys.size, axis[i]), ys.ravel(), zs.ravel()], axis=-1)
+        with np.errstate(all='ignore'):
+            dist = prim._map_primitive_batch(pos)[0].reshape(resolution, resolution)
+        grid[i] = np.nan_to_num(dist, nan=0.0, posinf=2 * radius, neginf=0.0)
+    grid.flush()
+    del grid
+    os.replace(tmp, path)
+    return path
+
+class BakedPrimitive(Primitive):
+    def __init__(self, source: Primitive, directory = os.path.join(settings.file_path, 'bake'), resolution = 128, radius = None):
+        super().__init__(source.pos_ev, source.rot_ev, source.scale_ev, source.pos_modifiers, source.dist_modifiers)
+        self.source = source
+        self.directory = directory
+        self.resolution = resolution
+        self.radius = radius
+        # Without a radius the grid follows the source's bounding radius, which animated sources can change.
+        self.fit_radius = radius is None
+        self.grid = None
+        self.grid_key = None
+
+    def __getstate__(self):
+        # The grid is reopened from its file on first use, so every process maps the same pages instead of
+        # receiving a copy with the scene.
+        state = self.__dict__.copy()
+        state['grid'] = None
+        state['grid_key'] = None
+        return state
+
+    def _load_grid(self):
+        key = hashlib.sha1(repr([_local_parameters(self.source), self.resolution, self.radius]).encode()).hexdigest()
+        if key == self.grid_key:
+            return
+        path = os.path.join(self.directory, key + '.npy')
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            bake_distance_field(self.source, path, self.resolution, self.radius)
+        self.grid = np.load(path, mmap_mode='r')
+        self.grid_key = key
+        self.cell_size = 2 * self.radius / (self.resolution - 1)
+        self.cell_diagonal = self.cell_size * math.sqrt(3)
+
+    def _map_primitive_batch(self, pos):
+        # Lower bound from the grid, the SDF can drop by at most one cell diagonal between samples.
+        if self.grid is None:
+            self._load_grid()
+        u = (pos + self.radius) / self.cell_size
+        outside = np.maximum(np.abs(pos) - self.radius, 0)
+        i = np.clip(np.floor(u).astype(np.int64), 0, self.resolution - 2)
+        f = np.clip(u - i, 0, 1)
+        g = self.grid
+        x0, y0, z0 = i[:, 0], i[:, 1], i[:, 2]
+        fx, fy, fz = f[:, 0], f[:, 1], f[:, 2]
+        c00 = g[x0, y0, z0] * (1 - fx) + g[x0 + 1, y0, z0] * fx
+        c10 = g[x0, y0 + 1, z0] * (1 - fx) + g[x0 + 1, y0 + 1, z0] * fx
+        c01 = g[x0, y0, z0 + 1] * (1 - fx) + g[x0 + 1, y0, z0 + 1] * fx
+        c11 = g[x0, y0 + 1, z0 + 1] * (1 - fx) + g[x0 + 1, y0 + 1, z0 + 1] * fx
+        dist = (c00 * (1 - fy) + c10 * fy) * (1 - fz) + (c01 * (1 - fy) + c11 * fy) * fz - self.cell_diagonal
+        outside = np.linalg.norm(outside, axis=-1)
+        dist = np.where(outside > 0, np.maximum(outside, dist - outside), dist)
+        albedo = np.zeros((len(pos), 3))
+
+        # Close to the surface the grid is too coarse, answer those points exactly.
+        near = np.flatnonzero(dist < self.cell_diagonal)
+        if len(near) > 0:
+            dist[near], albedo[near] = self.source._map_primitive_batch(pos[near])
+        return dist, albedo
+
+    def _gradient_batch(self, pos):
+        return self.source._gradient_batch(pos)
+
+    def _bounding_radius(self):
+        return self.radius
 
     def evaluate(self, t):
         super().evaluate(t)
-        self.power = self.power_ev.evaluate(t)
+        if evaluator.update(self.source, t) or self.grid_key is None:
+            if self.fit_radius:
+                self.radius = self.source._bounding_radius()
+            self._load_grid()
 
 # class FlowerLike(Primitive):
 #     def __init__(self, pos):
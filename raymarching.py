@@ -5,6 +5,9 @@ import helpers
 import film
 import color_filter
 import renderer
+import pipeline
+import manifest
+import frame_cache
 import solver
 import shader
 import primitive
@@ -76,27 +79,41 @@ shader_o.set_background_shader(shader.BackgroundLinearYGradient([0.05, 0.02, 0.0
 
 if __name__ == "__main__":
     freeze_support()
-    renderer_o = renderer.SolverRenderer(camera_o, film_o, solver, shader_o)
-
-    if(settings.video_render):
-        for frame in progressbar.progressbar(range(settings.start_frame, settings.end_frame)):
-            renderer_o.evaluate(frame / settings.ups)
+    renderer_o = renderer.SolverRenderer(camera_o, film_o, solver, shader_o, frame_cache.FrameCache() if settings.frame_cache else None)
+
+    # close releases the render pool and any shared memory buffers, also when rendering fails.
+    try:
+        if(settings.video_render):
+            frames = range(settings.start_frame, settings.end_frame)
+            sink = helpers.VideoSink() if settings.stream_video else None
+            save_png = sink is None or settings.save_png_frames
+            manifest_o = manifest.RenderManifest(renderer_o.scene_hash()) if settings.resume_render and save_png else None
+            pipeline_o = pipeline.AnimationPipeline(renderer_o, sink, save_png, manifest=manifest_o)
+            for frame in progressbar.progressbar(pipeline_o.run(frames), max_value=len(frames)):
+                pass
+
+
+            renderer_o.close()
+            if sink is None:
+                helpers.save_video()
+            else:
+                sink.close()
+        else:
+            renderer_o.evaluate(settings.still_render_t)
             renderer_o.prepare_render()
-            renderer_o.render()
-            img = renderer_o.get_image()
-            img.raw.save(os.path.join(settings.file_path, "img_raw" + str(frame) + ".png"))
-            img.processed.save(os.path.join(settings.file_path, "img" + str(frame) + ".png"))
-
+            if(settings.progressive_render):
+                def save_progress(i, stride, image):
+                    image.save(os.path.join(settings.file_path, "progress" + str(i) + ".png"))
+                renderer_o.render_progressive(save_progress)
+            else:
+                renderer_o.render()
 
-        helpers.save_video()
-    else:
-        renderer_o.evaluate(settings.still_render_t)
-        renderer_o.prepare_render()
-        renderer_o.render()
 
+            img = renderer_o.get_image()
+            img.raw.save(os.path.join(settings.file_path, "result_raw.png"))
+            img.processed.save(os.path.join(settings.file_path, "result.png"))
+            renderer_o.close()
 
-        img = renderer_o.get_image()
-        img.raw.save(os.path.join(settings.file_path, "result_raw.png"))
-        img.processed.save(os.path.join(settings.file_path, "result.png"))
-
-        img.processed.show()
\ No newline at end of file
+            img.processed.show()
+    finally:
+        renderer_o.close()
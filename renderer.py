@@ -1,12 +1,39 @@
 from abc import ABCMeta, abstractmethod
 import camera
 import film
-from settings import width, height, tile_size, threads, end_frame, start_frame, fps, ups, file_path
+from settings import width, height, tile_size, threads, end_frame, start_frame, fps, ups, file_path, batch_march, cone_march_levels, print_march_stats, temporal_reprojection, adaptive_samples, adaptive_color_threshold, adaptive_depth_threshold, adaptive_sample_budget, progressive_strides, frame_parallel, frames_in_flight, bake_animation
 import solver
 import shader
+import helpers
+import evaluator
 from multiprocessing import Pool
+import pickle
+import copy
+from collections import deque
 import time
 import os
+import numpy as np
+from PIL import Image
+from dataclasses import dataclass
+
+@dataclass
+class MarchStats:
+    rays: int = 0
+    steps: int = 0
+    backtracks: int = 0
+
+    def add(self, stats):
+        self.rays += stats[0]
+        self.steps += stats[1]
+        self.backtracks += stats[2]
+
+    def steps_per_ray(self):
+        return self.steps / max(self.rays, 1)
+
+@dataclass
+class RawFrame:
+    data: np.ndarray
+    cache_key: str = None
 
 class Renderer(metaclass=ABCMeta):
     @abstractmethod
@@ -42,6 +69,10 @@ class CameraRayRenderer(Renderer):
             for y in range(height):
                 self.film.write_pixel(x, y, self.camera.generate_ray(x, y)[0])
                 
+    def scene_hash(self, digits = None):
+        # Identifies what is rendered, render buffers and scheduling state are left out.
+        return helpers.stable_hash([self.camera, self.film], digits)
+
     def get_image(self):
         return self.film.build_image()
 
@@ -51,63 +82,345 @@ class CameraRayRenderer(Renderer):
     def prepare_render(self):
         pass
 
+# Scene copy owned by a pool worker, broadcast once through the pool initializer.
+_worker_renderer = None
+_worker_t = None
+
+def _init_worker(scene):
+    global _worker_renderer
+    _worker_renderer = pickle.loads(scene)
+
+def _worker_evaluate(t):
+    global _worker_t
+    if t != _worker_t:
+        _worker_renderer.evaluate(t)
+        _worker_t = t
+
+def _render_tile(t, min_x, min_y, max_x, max_y, use_seed):
+    _worker_evaluate(t)
+    return _worker_renderer._render_tile_to_film(min_x, min_y, max_x, max_y, use_seed)
+
+def _render_tile_star(args):
+    return _render_tile(*args)
+
+def _render_samples(t, xs, ys):
+    _worker_evaluate(t)
+    return _worker_renderer._render_samples_to_film(xs, ys)
+
+def _render_pixels(t, xs, ys):
+    _worker_evaluate(t)
+    return _worker_renderer._render_pixels_to_film(xs, ys)
+
+def _render_frame(t, frame, save):
+    global _worker_t
+    # The frame render re-evaluates the shared scene objects, later tile tasks must evaluate again.
+    _worker_t = None
+    img = _worker_renderer._render_frame_local(t)
+    if save:
+        helpers.save_frame(img, frame)
+        return None
+    return img
+
+# Low discrepancy (R2 sequence) sub-pixel offsets in [-.5, .5), shared by every supersampled pixel.
+def _subpixel_offsets(n):
+    k = np.arange(1, n + 1)
+    return np.stack([(.5 + 0.7548776662466927 * k) % 1 - .5, (.5 + 0.5698402909980532 * k) % 1 - .5], axis=-1)
+
 class SolverRenderer(Renderer):
-    def __init__(self, camera: camera.Camera, film: film.Film, solver: solver.Solver, shader: shader.Shader):
+    def __init__(self, camera: camera.Camera, film: film.Film, solver: solver.Solver, shader: shader.Shader, frame_cache = None):
         self.camera = camera
         self.film = film
         self.solver = solver
         self.shader = shader
+        self.march_stats = MarchStats()
+        self.prev_hit_dist = None
+        self.prev_versions = None
+        self.seed_dist = None
+        self.hit_dist = None
+        self.tile_costs = {}
+        self.pool = None
+        self.t = None
+        self.threads = threads
+        self.frame_cache = frame_cache
         pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def _get_pool(self):
+        # Workers live for the whole session and receive the scene once, frames only send t.
+        if self.pool is None:
+            self._allocate_buffers()
+            self.pool = Pool(self.threads, initializer=_init_worker, initargs=(pickle.dumps(self),))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for buffer in [self.seed_dist, self.hit_dist]:
+            if buffer is not None:
+                buffer.release()
+        self.seed_dist = None
+        self.hit_dist = None
+        self.film.release()
         
     def render(self):
         render_time = time.perf_counter()
-        if(threads == 1):
-            e = self._render_thread(0, 0, width, height)
+        use_seed = self._begin_frame()
+
+        if(self.threads == 1):
+            self.march_stats.add(self._render_tile_to_film(0, 0, width, height, use_seed)['stats'])
             # print("Render took:" + str(time.perf_counter() - render_time))
-            for x in range(len(e['data'])):
-                for y in range(len(e['data'][x])):
-                    self.film.write_pixel(x + e['position'][0], y + e['position'][1], e['data'][x][y])
-            # print("Total took:" + str(time.perf_counter() - render_time))
+            self._end_frame()
             return
 
-        tiles_x = width / tile_size
-        tiles_y = height / tile_size
-
-        if tiles_x % 1 != 0:
-            tiles_x = tiles_x + 1
-        if tiles_y % 1 != 0:
-            tiles_y = tiles_y + 1
-
-        tiles_x = int(tiles_x)
-        tiles_y = int(tiles_y)
-
-        process_data = []
-        for tile_x in range(tiles_x):
-            for tile_y in range(tiles_y):
-                max_x = (tile_x + 1) * tile_size
-                max_y = (tile_y + 1) * tile_size
-                if(max_x >= width):
-                    max_x = width
-                if(max_y >= height):
-                    max_y = height
-                
-                # self._render_thread(tile_x * tile_size, tile_y * tile_size, max_x, max_y)
-
-                process_data.append((tile_x * tile_size, tile_y * tile_size, max_x, max_y))
-        pool = Pool(threads)
-        result = pool.starmap(self._render_thread, process_data)
-        pool.close()
-        pool.join()
-        # print("Render took:" + str(time.perf_counter() - render_time))
-        for e in result:
-            for x in range(len(e['data'])):
-                for y in range(len(e['data'][x])):
-                    self.film.write_pixel(y + e['position'][1], x + e['position'][0], e['data'][x][y])
+        # Most expensive tiles of the previous frame first, tiles without a measurement are treated as expensive.
+        tiles = sorted(self._tiles(), key=lambda tile: -self.tile_costs.get(tile, np.inf))
+        process_data = [(self.t,) + tile + (use_seed,) for tile in tiles]
+
+        # Workers write straight into the shared film and hit buffers, only a completion token travels back.
+        tile_costs = {}
+        for token in self._get_pool().imap_unordered(_render_tile_star, process_data):
+            self.march_stats.add(token['stats'])
+            tile_costs[token['tile']] = token['time']
+        self.tile_costs = tile_costs
         
         # print("Total took:" + str(time.perf_counter() - render_time))
+        self._end_frame()
+
+    def render_progressive(self, callback = None, strides = progressive_strides):
+        # Renders an interleaved subset of pixels per pass, coarse to fine, and hands a nearest-neighbour
+        # filled preview to callback(pass_index, stride, image) after each pass. Returning False stops refining.
+        self._begin_frame(False)
+        done = np.zeros((width, height), dtype=bool)
+        for i, stride in enumerate(strides):
+            todo = np.zeros((width, height), dtype=bool)
+            todo[::stride, ::stride] = True
+            xs, ys = np.nonzero(todo & ~done)
+            done |= todo
+            self._render_pixel_set(xs, ys, _render_pixels, self._render_pixels_to_film)
+
+            if callback is not None and callback(i, stride, self._preview_image(stride)) == False:
+                self._end_frame(False)
+                return False
+        self._end_frame()
+        return True
+
+    def _preview_image(self, stride):
+        rows = (np.arange(height) // stride) * stride
+        cols = (np.arange(width) // stride) * stride
+        preview = self.film.data[rows[:, None], cols[None, :]]
+        return Image.fromarray((np.clip(preview, 0, 1) * 255).astype('uint8'))
+
+    def _render_pixel_set(self, xs, ys, task, local):
+        if len(xs) == 0:
+            return
+        if(self.threads == 1):
+            self.march_stats.add(local(xs, ys))
+            return
+        chunks = np.array_split(np.arange(len(xs)), min(len(xs), self.threads * 4))
+        for stats in self._get_pool().starmap(task, [(self.t, xs[c], ys[c]) for c in chunks]):
+            self.march_stats.add(stats)
+
+    def render_animation(self, frames, save = False, frames_in_flight = frames_in_flight, post_process = True):
+        # Yields (frame, image) in frame order. With frame_parallel every pool worker renders whole frames,
+        # evaluation, post processing and with save also writing the pngs, then image is None.
+        # At most frames_in_flight frames are queued or finished but not yet yielded.
+        # Without post_process frames rendered here yield a RawFrame instead of an image, cache hits are always images.
+        frames = list(frames)
+        if bake_animation:
+            self.bake_timeline(frames)
+        split = 0
+        if frame_parallel and self.threads > 1:
+            # The last frames that cannot fill every worker are split into tiles instead.
+            split = len(frames) - len(frames) % self.threads
+        pending = deque()
+        for frame in frames[:split]:
+            pending.append((frame, self._get_pool().apply_async(_render_frame, (frame / ups, frame, save))))
+            if len(pending) >= max(frames_in_flight, 1):
+                done, result = pending.popleft()
+                yield done, result.get()
+        while pending:
+            done, result = pending.popleft()
+            yield done, result.get()
+
+        for frame in frames[split:]:
+            self.evaluate(frame / ups)
+            key, img = self._cached_frame()
+            if img is None:
+                self.prepare_render()
+                self.render()
+                if not post_process:
+                    yield frame, RawFrame(np.array(self.film.data), key)
+                    continue
+                img = self.get_image()
+                if key is not None:
+                    self.frame_cache.put(key, img)
+            if save:
+                helpers.save_frame(img, frame)
+                img = None
+            yield frame, img
+
+    def _render_frame_local(self, t):
+        # Private copy with process local buffers, the shared film and hit buffers belong to tile rendering.
+        local = copy.copy(self)
+        local.threads = 1
+        local.pool = None
+        local.film = copy.copy(self.film)
+        local.film.shared = None
+        local.seed_dist = None
+        local.hit_dist = None
+        local.prev_hit_dist = None
+        local.tile_costs = {}
+        local.evaluate(t)
+        key, img = local._cached_frame()
+        if img is not None:
+            return img
+        local.prepare_render()
+        local.render()
+        img = local.get_image()
+        local.close()
+        if key is not None:
+            self.frame_cache.put(key, img)
+        return img
+
+    def _cached_frame(self):
+        # (key, image) for the currently evaluated scene, image is None on a miss and key is None without a cache.
+        if self.frame_cache is None:
+            return None, None
+        key = self.frame_cache.key(self)
+        return key, self.frame_cache.get(key)
+
+    def _allocate_buffers(self):
+        if self.hit_dist is None:
+            self.seed_dist = helpers.SharedArray((width, height), np.float64, self.threads > 1)
+            self.hit_dist = helpers.SharedArray((width, height), np.float64, self.threads > 1)
+        if self.film.shared is None:
+            self.prepare_render()
+
+    def _begin_frame(self, reproject = True):
+        self.march_stats = MarchStats()
+        self._allocate_buffers()
+        seed = self._temporal_seed() if temporal_reprojection and reproject else None
+        if seed is not None:
+            self.seed_dist.array[:] = seed
+        self.hit_dist.array.fill(np.inf)
+        return seed is not None
+
+    def _end_frame(self, adaptive = True):
+        # Aborted frames skip supersampling, their edges would be against pixels that were never rendered.
+        if adaptive:
+            self._adaptive_pass()
+        self._finish_temporal()
+        self._report_march_stats()
+
+    def _adaptive_pass(self):
+        if adaptive_samples <= 0:
+            return
+        xs, ys = self._supersample_pixels()
+        self._render_pixel_set(xs, ys, _render_samples, self._render_samples_to_film)
+
+    def _supersample_pixels(self):
+        # Pixels that differ from a neighbour in colour, relative depth or hit state, worst first, capped by the sample budget.
+        col = self.film.data.transpose(1, 0, 2)
+        hit_dist = self.hit_dist.array
+        hit = np.isfinite(hit_dist)
+        depth = np.where(hit, hit_dist, 0)
+        score = np.zeros((width, height))
+        for axis in [0, 1]:
+            col_diff = np.abs(np.diff(col, axis=axis)).max(axis=-1) / adaptive_color_threshold
+            with np.errstate(invalid='ignore', divide='ignore'):
+                depth_diff = np.abs(np.diff(depth, axis=axis)) / np.maximum(np.minimum(depth[:-1] if axis == 0 else depth[:, :-1], depth[1:] if axis == 0 else depth[:, 1:]), 1e-6) / adaptive_depth_threshold
+            depth_diff[~np.isfinite(depth_diff)] = 0
+            hit_diff = np.where(np.diff(hit, axis=axis), np.inf, 0)
+            edge = np.maximum(np.maximum(col_diff, depth_diff), hit_diff)
+            if axis == 0:
+                score[:-1] = np.maximum(score[:-1], edge)
+                score[1:] = np.maximum(score[1:], edge)
+            else:
+                score[:, :-1] = np.maximum(score[:, :-1], edge)
+                score[:, 1:] = np.maximum(score[:, 1:], edge)
+
+        xs, ys = np.nonzero(score > 1)
+        order = np.argsort(-score[xs, ys], kind='stable')[:adaptive_sample_budget // adaptive_samples]
+        return xs[order], ys[order]
+
+    def _render_samples_to_film(self, xs, ys):
+        colors = np.zeros((len(xs), 3))
+        steps = 0
+        for offset in _subpixel_offsets(adaptive_samples):
+            ray = self.camera.generate_ray_batch(xs + offset[0], ys + offset[1])
+            solve = self.solver.solve_batch(ray[1], ray[0])
+            colors += self._shade_batch(solve, xs, ys)
+            steps += int(solve.bounces.sum())
+        self.film.blend_pixels(xs, ys, colors / adaptive_samples, adaptive_samples / (adaptive_samples + 1))
+        return [len(xs) * adaptive_samples, steps, 0]
+
+    def _render_pixels_to_film(self, xs, ys):
+        ray = self.camera.generate_ray_batch(xs, ys)
+        solve = self.solver.solve_batch(ray[1], ray[0])
+        self.film.write_pixels(xs, ys, self._shade_batch(solve, xs, ys))
+        self.hit_dist.array[xs, ys] = np.where(solve.hit, solve.dist, np.inf)
+        return [len(solve), int(solve.bounces.sum()), solve.backtracks]
+
+    def _shade_batch(self, solve, xs, ys):
+        colors = np.empty((len(xs), 3))
+        for i in range(len(xs)):
+            colors[i] = self.shader.shade(solve.get(i), xs[i], ys[i])
+        return colors
+
+    def _tiles(self):
+        tiles = []
+        for min_x in range(0, width, tile_size):
+            for min_y in range(0, height, tile_size):
+                tiles.append((min_x, min_y, min(min_x + tile_size, width), min(min_y + tile_size, height)))
+        return tiles
+
+    def _render_tile_to_film(self, min_x, min_y, max_x, max_y, use_seed):
+        tile_time = time.perf_counter()
+        seed = self.seed_dist.array[min_x:max_x, min_y:max_y] if use_seed else None
+        e = self._render_thread(min_x, min_y, max_x, max_y, seed)
+        self.film.write_tile(min_x, min_y, e['data'])
+        if 'hit_dist' in e:
+            self.hit_dist.array[min_x:max_x, min_y:max_y] = e['hit_dist']
+        return {'tile': (min_x, min_y, max_x, max_y), 'stats': e['stats'], 'time': time.perf_counter() - tile_time}
+
+    def _finish_temporal(self):
+        # Distances to this frame's hits, with the versions of the scene they were measured against.
+        self.prev_hit_dist = None
+        self.prev_versions = None
+        if not temporal_reprojection:
+            return
+        self.prev_hit_dist = np.array(self.hit_dist.array)
+        tracker = vars(self.camera).get('changes')
+        self.prev_versions = (None if tracker is None else tracker.version, self.solver.versions())
+
+    def _temporal_seed(self):
+        # While the camera stands still every ray is the same as last frame, and everything in front of its last hit
+        # was empty. The solver cuts that back to what geometry changed since can have moved into.
+        tracker = vars(self.camera).get('changes')
+        if self.prev_hit_dist is None or tracker is None or tracker.version != self.prev_versions[0]:
+            return None
+        seed = np.zeros((width, height))
+        xs, ys = np.nonzero(np.isfinite(self.prev_hit_dist))
+        if len(xs) > 0:
+            ray = self.camera.generate_ray_batch(xs, ys)
+            seed[xs, ys] = self.solver.verify_start_batch(ray[1], ray[0], self.prev_hit_dist[xs, ys], self.prev_versions[1])
+        return seed
+
+    def _report_march_stats(self):
+        if print_march_stats:
+            print("March steps: " + str(self.march_stats.steps) + " (" + str(round(self.march_stats.steps_per_ray(), 2)) + " per ray), backtracks: " + str(self.march_stats.backtracks))
         
-    def _render_thread(self, min_x, min_y, max_x, max_y):
+    def _render_thread(self, min_x, min_y, max_x, max_y, seed = None):
+        if batch_march:
+            return self._render_thread_batch(min_x, min_y, max_x, max_y, seed)
         elements = []
+        steps = 0
         for x in range(min_x, max_x):
             curX = []
             for y in range(min_y, max_y):
@@ -116,18 +429,70 @@ class SolverRenderer(Renderer):
                 # col = [1 / solve.dist, 1 / solve.dist, 1 / solve.dist
                 col = self.shader.shade(solve, x, y)
                 curX.append(col)
+                steps += solve.bounces
             elements.append(curX)
-        return {'data': elements, 'position': [min_x, min_y, max_x, max_y]}
+        return {'data': elements, 'position': [min_x, min_y, max_x, max_y], 'stats': [(max_x - min_x) * (max_y - min_y), steps, 0]}
+
+    def _render_thread_batch(self, min_x, min_y, max_x, max_y, seed = None):
+        xs, ys = np.meshgrid(np.arange(min_x, max_x), np.arange(min_y, max_y), indexing='ij')
+        xs = xs.ravel()
+        ys = ys.ravel()
+        ray = self.camera.generate_ray_batch(xs, ys)
+        start_dist = None
+        if cone_march_levels:
+            start_dist = self._cone_prepass(min_x, min_y, max_x, max_y).ravel()
+        if seed is not None:
+            seed = seed.ravel()
+            start_dist = seed if start_dist is None else np.maximum(start_dist, seed)
+        solve = self.solver.solve_batch(ray[1], ray[0], start_dist)
+
+        elements = np.empty((max_x - min_x, max_y - min_y, 3), dtype=np.float32)
+        i = 0
+        for x in range(min_x, max_x):
+            for y in range(min_y, max_y):
+                elements[x - min_x, y - min_y] = self.shader.shade(solve.get(i), x, y)
+                i += 1
+        hit_dist = np.where(solve.hit, solve.dist, np.inf).reshape(max_x - min_x, max_y - min_y)
+        return {'data': elements, 'position': [min_x, min_y, max_x, max_y], 'stats': [len(solve), int(solve.bounces.sum()), solve.backtracks], 'hit_dist': hit_dist}
                 
                 
+    def _cone_prepass(self, min_x, min_y, max_x, max_y):
+        # Coarse to fine cone march over pixel blocks, every level starts where its enclosing block became unsafe.
+        safe = np.zeros((max_x - min_x, max_y - min_y))
+        for block in cone_march_levels:
+            bx, by = np.meshgrid(np.arange(min_x, max_x, block), np.arange(min_y, max_y, block), indexing='ij')
+            bx = bx.ravel()
+            by = by.ravel()
+            ex = np.minimum(bx + block, max_x)
+            ey = np.minimum(by + block, max_y)
+
+            start = np.array([safe[x0 - min_x:x1 - min_x, y0 - min_y:y1 - min_y].min() for x0, y0, x1, y1 in zip(bx, by, ex, ey)])
+            cone = self.camera.generate_cone_batch(bx, by, ex, ey)
+            block_safe = self.solver.cone_march_batch(cone[1], cone[0], cone[2], start)
+
+            for x0, y0, x1, y1, d in zip(bx, by, ex, ey, block_safe):
+                safe[x0 - min_x:x1 - min_x, y0 - min_y:y1 - min_y] = d
+        return safe
+
+    def scene_hash(self, digits = None):
+        # Identifies what is rendered, render buffers and scheduling state are left out.
+        return helpers.stable_hash([self.camera, self.solver, self.shader, self.film], digits)
+
+    def bake_timeline(self, frames):
+        # Samples the animated parameters at every frame's time up front, workers get the tracks with the scene.
+        evaluator.bake_timeline([self.camera, self.solver, self.shader, self.film], np.asarray(frames, dtype=np.float64) / ups)
+
     def get_image(self):
         return self.film.build_image()
 
     def evaluate(self, t):
-        self.camera.evaluate(t)
-        self.solver.evaluate(t)
-        self.film.evaluate(t)
-        self.shader.evaluate(t)
+        # Nodes without animated parameters are only evaluated the first time.
+        self.t = t
+        evaluator.update(self.camera, t)
+        evaluator.update(self.solver, t)
+        evaluator.update(self.film, t)
+        evaluator.update(self.shader, t)
 
     def prepare_render(self):
+        self.film.shared_memory = self.threads > 1
         self.film.prepare_render()
\ No newline at end of file
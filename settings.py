@@ -5,10 +5,32 @@ step_number = 64
 min_dist = 0.001
 max_dist = 300.0
 small_step = 0.001
-tile_size = 128
+tile_size = 32
 epsilon = .0001
+batch_march = True
+# Fuses every primitive's transform, modifiers and SDF into generated NumPy code after each evaluate.
+compile_scene = True
+# 'numba' JIT compiles the march loop and built-in SDFs when numba is installed, 'numpy' never, 'auto' when available.
+march_backend = 'auto'
+bvh_leaf_size = 4
+cone_march_levels = []
+# Step factor of the batch marcher, 1 is plain sphere tracing. Above 1 saves steps on smooth distance fields, fractal
+# distance estimators like the Mandelbulb backtrack on nearly every ray and take more steps, so keep 1 unless measured.
+over_relaxation = 1.0
+print_march_stats = False
+# Prints the peak memory of post processing, frame buffer included, for every built image.
+print_post_stats = False
+# Starts rays at last frame's hit distance while the camera stands still, cut back in front of geometry that changed.
+# Shaders colouring by step count, like the fractal rim, see the shorter marches.
+temporal_reprojection = False
+adaptive_samples = 0
+adaptive_color_threshold = .1
+adaptive_depth_threshold = .05
+adaptive_sample_budget = 262144
 
 threads = 22
+frame_parallel = False
+frames_in_flight = threads * 2
 fps = 24
 ups = 48
 end_frame = 48 * 5
@@ -16,5 +38,19 @@ start_frame = 2
 still_render_t = 0.6
 
 video_render = True
+# Pipe frames straight into ffmpeg, png frames are then only written with save_png_frames.
+stream_video = True
+save_png_frames = False
+pipeline_queue_size = 4
+# Skips frames the manifest in file_path lists as rendered with the same scene and settings, needs png frames.
+resume_render = True
+# Reuses finished frames whose evaluated scene matches, floats compared to frame_cache_digits significant digits.
+frame_cache = True
+frame_cache_size = 1024 ** 3
+frame_cache_digits = 10
+# Samples every animated parameter for all frames of an animation up front, evaluate then looks values up.
+bake_animation = True
+progressive_render = False
+progressive_strides = [8, 4, 2, 1]
 
 file_path = 'results/'
\ No newline at end of file
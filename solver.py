@@ -1,9 +1,12 @@
 from abc import ABCMeta, abstractmethod
-from settings import max_dist, min_dist, step_number, small_step
-import helpers
+from settings import max_dist, min_dist, step_number, small_step, over_relaxation, compile_scene
 import math
 import primitive
+from bvh import BoundingVolumeHierarchy
 import modifiers
+import compiler
+import jit
+import evaluator
 import numpy as np
 from dataclasses import dataclass
 
@@ -16,6 +19,24 @@ class IntersectionInfo:
     normal: [float]
     position: [float]
 
+@dataclass
+class BatchIntersectionInfo:
+    hit: np.ndarray
+    dist: np.ndarray
+    albedo: np.ndarray
+    bounces: np.ndarray
+    normal: np.ndarray
+    position: np.ndarray
+    backtracks: int = 0
+
+    def __len__(self):
+        return len(self.hit)
+
+    def get(self, i) -> IntersectionInfo:
+        if not self.hit[i]:
+            return IntersectionInfo(False, float(self.dist[i]), self.albedo[i].tolist(), int(self.bounces[i]), None, self.position[i].tolist())
+        return IntersectionInfo(True, float(self.dist[i]), self.albedo[i].tolist(), int(self.bounces[i]), self.normal[i].tolist(), self.position[i].tolist())
+
 class Solver(metaclass=ABCMeta):
     @abstractmethod
     def __init__(self):
@@ -25,27 +46,102 @@ class Solver(metaclass=ABCMeta):
     def solve(self, pos, ray) -> IntersectionInfo:
         pass
 
+    def solve_batch(self, origins, directions, start_dist = None) -> BatchIntersectionInfo:
+        n = len(origins)
+        if start_dist is None:
+            start_dist = np.zeros(n)
+        origins = origins + directions * start_dist[:, None]
+        res = BatchIntersectionInfo(np.zeros(n, dtype=bool), np.zeros(n), np.zeros((n, 3)), np.zeros(n, dtype=np.int32), np.zeros((n, 3)), np.zeros((n, 3)))
+        for i in range(n):
+            solve = self.solve(list(origins[i]), list(directions[i]))
+            res.hit[i] = solve.hit
+            res.dist[i] = solve.dist + start_dist[i]
+            res.albedo[i] = solve.albedo
+            res.bounces[i] = solve.bounces
+            res.position[i] = solve.position
+            if solve.hit:
+                res.normal[i] = solve.normal
+        return res
+
+    def cone_march_batch(self, origins, directions, cone_tan, start_dist = None) -> np.ndarray:
+        # Distance along each cone axis up to which the cone is known to be empty, solvers without support know nothing.
+        return np.zeros(len(origins)) if start_dist is None else np.array(start_dist, dtype=np.float64)
+
+    def versions(self):
+        # Snapshot of the scene state verify_start_batch of a later frame compares against.
+        return None
+
+    def verify_start_batch(self, origins, directions, start_dist, versions) -> np.ndarray:
+        # Of distances along the rays that were empty when versions were taken, the part that is still empty.
+        # Solvers that cannot tell start from zero.
+        return np.zeros(len(origins))
+
     @abstractmethod
     def evaluate(self, t):
         pass
 
 class GeneralSolver(Solver):
-    def __init__(self, primitives: [primitive.Primitive], pos_modifiers: [modifiers.PosModifier]):
+    def __init__(self, primitives: [primitive.Primitive], pos_modifiers: [modifiers.PosModifier], over_relaxation = over_relaxation):
         self.primitives = primitives
         self.pos_modifiers = pos_modifiers
+        self.over_relaxation = over_relaxation
+        self.compile_scene = compile_scene
+        self.compiled = None
+        self.jit = None
+        self.bvh = None
+
+    def __getstate__(self):
+        # Generated functions cannot be pickled, receivers compile again in their own evaluate.
+        state = self.__dict__.copy()
+        state['compiled'] = None
+        state['jit'] = None
+        return state
         
     def solve(self, pos, ray):
         res = self._solve_world(pos, ray)
         if not res[0]:
             return IntersectionInfo(False, res[1], res[2], res[3], None, res[4])
         normal = self._calculate_normal(res[4])
-        return IntersectionInfo(True, res[1], res[2], res[3], normal, res[3])
+        return IntersectionInfo(True, res[1], res[2], res[3], normal, res[4])
+
+    def solve_batch(self, origins, directions, start_dist = None):
+        res, index = self._solve_world_batch(origins, directions, start_dist)
+        if res.hit.any():
+            res.normal[res.hit] = self._calculate_normal_batch(res.position[res.hit], index[res.hit])
+        return res
 
     def _calculate_normal(self, pos):
-        gradient_x = self._map_world([pos[0] + small_step, pos[1], pos[2]]).distance - self._map_world([pos[0] - small_step, pos[1], pos[2]]).distance
-        gradient_y = self._map_world([pos[0], pos[1] + small_step, pos[2]]).distance - self._map_world([pos[0], pos[1] - small_step, pos[2]]).distance
-        gradient_z = self._map_world([pos[0], pos[1], pos[2] + small_step]).distance - self._map_world([pos[0], pos[1], pos[2] - small_step]).distance
-        return helpers.vec_normalize([gradient_x, gradient_y, gradient_z])
+        return self._calculate_normal_batch(np.array([pos], dtype=np.float64))[0].tolist()
+
+    def _calculate_normal_batch(self, pos, index=None):
+        gradient = np.empty_like(pos)
+        remaining = np.ones(len(pos), dtype=bool)
+        if not self.pos_modifiers:
+            if index is None:
+                index = self._map_world_batch(pos)[2]
+            with np.errstate(all='ignore'):
+                for i, prim in enumerate(self.primitives):
+                    sel = np.flatnonzero(index == i)
+                    if len(sel) == 0:
+                        continue
+                    g = prim.gradient_batch(pos[sel])
+                    if g is None:
+                        continue
+                    gradient[sel] = g
+                    remaining[sel] = False
+        gradient[~np.isfinite(gradient).all(axis=-1)] = 0
+        remaining |= ~gradient.any(axis=-1)
+        if remaining.any():
+            gradient[remaining] = self._tetrahedral_gradient_batch(pos[remaining])
+        length = np.linalg.norm(gradient, axis=-1, keepdims=True)
+        return np.divide(gradient, length, out=gradient, where=length > 0)
+
+    def _tetrahedral_gradient_batch(self, pos):
+        n = len(pos)
+        taps = np.array([[1, -1, -1], [-1, -1, 1], [-1, 1, -1], [1, 1, 1]], dtype=np.float64)
+        samples = (pos[None, :, :] + taps[:, None, :] * small_step).reshape(-1, 3)
+        dist = self._map_world_batch(samples)[0].reshape(4, n)
+        return dist.T @ taps
 
     def _solve_world(self, pos, ray):
         total_dist = 0
@@ -61,21 +157,146 @@ class GeneralSolver(Solver):
             pos = [pos[0] + ray[0] * estimator, pos[1] + ray[1] * estimator, pos[2] + ray[2] * estimator]
         return [False, total_dist, [0,0,0], step_number, pos]
 
+    def cone_march_batch(self, origins, directions, cone_tan, start_dist = None):
+        pos = np.array(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        total_dist = np.zeros(len(pos)) if start_dist is None else np.array(start_dist, dtype=np.float64)
+        pos += directions * total_dist[:, None]
+
+        active = np.arange(len(pos))
+        for i in range(step_number):
+            if len(active) == 0:
+                break
+            dist = self._map_world_batch(pos[active])[0]
+            # Largest step for which the unbounding sphere still covers the whole cone cross-section.
+            k = cone_tan[active]
+            step = (dist - total_dist[active] * k) / (1 + k)
+
+            go_on = (step > min_dist) & (dist <= max_dist)
+            active = active[go_on]
+            step = step[go_on]
+            total_dist[active] += step
+            pos[active] += directions[active] * step[:, None]
+        return total_dist
+
+    def versions(self):
+        # Change versions of the primitives as of the last evaluate, None before their first update.
+        trackers = [vars(p).get('changes') for p in self.primitives]
+        if any(t is None for t in trackers):
+            return None
+        return [t.version for t in trackers]
+
+    def verify_start_batch(self, origins, directions, start_dist, versions):
+        # start_dist was empty when versions were taken. Only primitives changed since can have moved into it, so each
+        # ray is cut back to where it enters their current bounding spheres. Position modifiers warp the space the
+        # bounds live in and unbounded primitives could be anywhere, then nothing is kept.
+        current = self.versions()
+        origins = np.asarray(origins, dtype=np.float64)
+        if self.pos_modifiers or versions is None or current is None or len(versions) != len(current):
+            return np.zeros(len(origins))
+        start = np.array(start_dist, dtype=np.float64)
+        for i, (before, now) in enumerate(zip(versions, current)):
+            if before == now:
+                continue
+            if i not in self.bvh.bounds:
+                return np.zeros(len(origins))
+            # Rays passing within min_dist of a surface already count as hits.
+            center, radius = self.bvh.bounds[i]
+            radius = radius + min_dist
+            offset = center - origins
+            b = np.sum(offset * directions, axis=-1)
+            disc = b * b - np.sum(offset * offset, axis=-1) + radius * radius
+            root = np.sqrt(np.maximum(disc, 0))
+            enters = (disc >= 0) & (b + root >= 0)
+            start = np.where(enters, np.minimum(start, np.maximum(b - root, 0)), start)
+        return start
+
+    def _solve_world_batch(self, origins, directions, start_dist = None):
+        if self.jit is not None:
+            hit, total_dist, albedo, bounces, pos, index, backtracks = self.jit.march(origins, directions, start_dist, self.over_relaxation)
+            return BatchIntersectionInfo(hit, total_dist, albedo, bounces, np.zeros((len(hit), 3)), pos, backtracks), index
+        pos = np.array(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        n = len(pos)
+        hit = np.zeros(n, dtype=bool)
+        total_dist = np.zeros(n) if start_dist is None else np.array(start_dist, dtype=np.float64)
+        pos += directions * total_dist[:, None]
+        albedo = np.zeros((n, 3))
+        bounces = np.full(n, step_number, dtype=np.int32)
+        index = np.full(n, -1)
+
+        # Over-relaxed steps of omega * d, a ray falls back to omega = 1 once its unbounding spheres stop overlapping.
+        omega = np.full(n, float(self.over_relaxation))
+        prev_dist = np.zeros(n)
+        step = np.zeros(n)
+        backtracks = 0
+
+        # Indices of rays that are still marching, shrinks as rays hit or escape.
+        active = np.arange(n)
+        for i in range(step_number):
+            if len(active) == 0:
+                break
+            dist, alb, closest = self._map_world_batch(pos[active])
+
+            fail = (omega[active] > 1) & (dist + prev_dist[active] < step[active])
+            if fail.any():
+                failed = active[fail]
+                back = step[failed] - prev_dist[failed]
+                total_dist[failed] -= back
+                pos[failed] -= directions[failed] * back[:, None]
+                step[failed] = prev_dist[failed]
+                omega[failed] = 1
+                backtracks += len(failed)
+
+            hit_now = ~fail & (dist < min_dist)
+            done = hit_now | (~fail & (dist > max_dist))
+            if done.any():
+                hit_idx = active[hit_now]
+                hit[hit_idx] = True
+                albedo[hit_idx] = alb[hit_now]
+                index[hit_idx] = closest[hit_now]
+                bounces[active[done]] = i
+
+            advance = ~fail & ~done
+            active_next = active[fail | advance]
+            active = active[advance]
+            dist = dist[advance]
+
+            step[active] = omega[active] * dist
+            prev_dist[active] = dist
+            total_dist[active] += step[active]
+            pos[active] += directions[active] * step[active][:, None]
+            active = active_next
+
+        return BatchIntersectionInfo(hit, total_dist, albedo, bounces, np.zeros((n, 3)), pos, backtracks), index
+
     def _map_world(self, pos):
-        
+        dist, albedo, index = self._map_world_batch(np.array([pos], dtype=np.float64))
+        return primitive.MapReturn(albedo[0].tolist(), float(dist[0]))
+
+    def _map_world_batch(self, pos):
+        if self.compiled is not None:
+            return self.compiled.map_world(pos)
         for m in self.pos_modifiers:
-            pos = m.modify(pos)
+            pos = m.modify_batch(pos)
 
-        lowest_dist = primitive.MapReturn([0,0,0], max_dist * 2)
-        for prim in self.primitives:
-            dist = prim.map_primitive(pos)
-            if(dist.distance < lowest_dist.distance):
-                lowest_dist = dist
- 
-        return lowest_dist
+        return self.bvh.map_batch(pos)
 
     def evaluate(self, t):
+        # The hierarchy and generated code only depend on evaluated values, they are rebuilt when those changed.
+        changed = False
         for p in self.primitives:
-            p.evaluate(t)
+            changed = evaluator.update(p, t) or changed
         for m in self.pos_modifiers:
-            m.evaluate(t)
\ No newline at end of file
+            changed = evaluator.update(m, t) or changed
+        if not changed and self.bvh is not None and (self.compiled is not None or not self.compile_scene):
+            return
+        self.compiled = None
+        if self.compile_scene:
+            compiled = compiler.compile_scene(self.primitives, self.pos_modifiers)
+            self.bvh = BoundingVolumeHierarchy(self.primitives, compiled.kernels)
+            compiled.params[0] = self.bvh
+            self.compiled = compiled
+        else:
+            self.bvh = BoundingVolumeHierarchy(self.primitives)
+        self.jit = jit.compile_scene(self.primitives, self.pos_modifiers)
\ No newline at end of file
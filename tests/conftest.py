@@ -0,0 +1,15 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+
+# Small single process renders on the NumPy marcher, modules read these when they are first imported.
+settings.width = 32
+settings.height = 32
+settings.tile_size = 16
+settings.threads = 1
+settings.march_backend = 'numpy'
+settings.print_march_stats = False
+settings.print_post_stats = False
@@ -0,0 +1,15 @@
+import camera
+import film
+import frame_cache
+import renderer
+
+
+def test_camera_ray_renderer_cache_key(tmp_path):
+    cache = frame_cache.FrameCache(str(tmp_path))
+    r = renderer.CameraRayRenderer(camera.PinholeCamera([0, 0, 3]), film.BasicFilm())
+    r.camera.evaluate(0)
+    key = cache.key(r)
+    assert key == cache.key(renderer.CameraRayRenderer(r.camera, film.BasicFilm()))
+    moved = camera.PinholeCamera([0, 0, 2])
+    moved.evaluate(0)
+    assert key != cache.key(renderer.CameraRayRenderer(moved, film.BasicFilm()))
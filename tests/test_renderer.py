@@ -0,0 +1,56 @@
+import numpy as np
+import camera
+import film
+import primitive
+import renderer
+import shader
+import solver
+from evaluator import InterpolatorEvaluator
+
+
+def _moving_occluder():
+    # A sphere sweeping across the view in front of a wall, seen by a static camera.
+    primitives = [
+        primitive.BoxPrimitive([0, 0, -4], [6, 6, .2]),
+        primitive.SpherePrimitive([InterpolatorEvaluator(-2.5, 2.5, 1, False), 0, -1], .8)
+    ]
+    r = renderer.SolverRenderer(camera.PinholeCamera([0, 0, 3]), film.BasicFilm(), solver.GeneralSolver(primitives, []), shader.ColorShader())
+    r.threads = 1
+    return r
+
+def _render_series(frames, monkeypatch):
+    # Counts every distance evaluation, whether it happens in a march or anywhere else.
+    samples = [0]
+    map_world_batch = solver.GeneralSolver._map_world_batch
+    def counted(self, pos, *args, **kwargs):
+        samples[0] += len(pos)
+        return map_world_batch(self, pos, *args, **kwargs)
+    monkeypatch.setattr(solver.GeneralSolver, '_map_world_batch', counted)
+    r = _moving_occluder()
+    images = []
+    hit_dist = []
+    for t in frames:
+        r.evaluate(t)
+        r.prepare_render()
+        r.render()
+        images.append(np.asarray(r.get_image().raw))
+        hit_dist.append(np.array(r.hit_dist.array))
+    r.close()
+    monkeypatch.setattr(solver.GeneralSolver, '_map_world_batch', map_world_batch)
+    return images, hit_dist, samples[0]
+
+
+def test_reprojection_seeds_match_full_march(monkeypatch):
+    # Enough steps that no ray of either render runs out of them, so both must find the same surfaces.
+    monkeypatch.setattr(solver, 'step_number', 256)
+    frames = [i / 8 for i in range(8)]
+    monkeypatch.setattr(renderer, 'temporal_reprojection', False)
+    full, full_dist, full_samples = _render_series(frames, monkeypatch)
+    monkeypatch.setattr(renderer, 'temporal_reprojection', True)
+    seeded, seeded_dist, seeded_samples = _render_series(frames, monkeypatch)
+    assert seeded_samples < full_samples * .8
+    for a, b in zip(seeded, full):
+        np.testing.assert_array_equal(a, b)
+    # The shader paints every hit alike, a seed skipping the sphere only shows in the distance to the wall behind it.
+    for a, b in zip(seeded_dist, full_dist):
+        np.testing.assert_allclose(a, b, rtol=0, atol=.01)
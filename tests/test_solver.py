@@ -0,0 +1,53 @@
+import numpy as np
+import camera
+import film
+import primitive
+import renderer
+import shader
+import solver
+from evaluator import InterpolatorEvaluator
+
+
+def _spheres():
+    return [primitive.SpherePrimitive([x, 0, -6], .6) for x in (-2, 0, 2)]
+
+def _render(primitives, over_relaxation = 1.0):
+    s = solver.GeneralSolver(primitives, [], over_relaxation)
+    r = renderer.SolverRenderer(camera.PinholeCamera([0, 0, 4], [-20, 0, 0]), film.BasicFilm(), s, shader.ColorShader())
+    r.threads = 1
+    r.evaluate(0)
+    r.prepare_render()
+    r.render()
+    img = np.asarray(r.get_image().raw)
+    stats = r.march_stats
+    r.close()
+    return img, stats
+
+
+def test_over_relaxation_saves_steps():
+    _, plain = _render(_spheres())
+    _, relaxed = _render(_spheres(), 1.5)
+    assert relaxed.rays == plain.rays
+    assert relaxed.steps < plain.steps * .9
+    assert relaxed.backtracks > 0
+
+def test_over_relaxation_matches_plain_image():
+    plain, _ = _render(_spheres())
+    relaxed, _ = _render(_spheres(), 1.5)
+    np.testing.assert_array_equal(relaxed, plain)
+
+def test_verify_start_cuts_seeds_at_changed_primitives():
+    sphere = primitive.SpherePrimitive([InterpolatorEvaluator(0, 6, 1, False), 0, -2], .5)
+    s = solver.GeneralSolver([primitive.SpherePrimitive([0, 3, -4], .5), sphere], [])
+    s.evaluate(.5)
+    versions = s.versions()
+    origins = np.zeros((2, 3))
+    directions = np.array([[0, 0, -1], [0, .6, -.8]], dtype=np.float64)
+    seeds = np.array([4.0, 4.0])
+    np.testing.assert_array_equal(s.verify_start_batch(origins, directions, seeds, versions), seeds)
+    # The moving sphere arrives in front of the first ray and cuts it back to its surface, the ray past the
+    # sphere that stood still keeps its seed.
+    s.evaluate(0)
+    verified = s.verify_start_batch(origins, directions, seeds, versions)
+    assert verified[0] <= 1.5
+    assert verified[1] == 4.0
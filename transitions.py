@@ -14,19 +14,25 @@ class Transition(metaclass=ABCMeta):
     def transition(self, f):
         pass
 
+    def transition_batch(self, f) -> np.ndarray:
+        return np.array([self.transition(v) for v in f.tolist()], dtype=np.float64)
+
 class Smoothstep(Transition):
     def __init__(self, amount):
         self.amount = amount
 
     def transition(self, f):
         if(self.amount == 1):
-            return (f * f * (3 - 2 * t));
+            return (f * f * (3 - 2 * f));
         if(self.amount == 2):
             return f * f * f * (f * (f * 6 - 15) + 10);
         else:
-            xsq = f * t; 
+            xsq = f * f; 
             xsqsq = xsq * xsq; 
             return xsqsq * (25.0 - 48.0 * f + xsq * (25.0 - xsqsq));
+
+    def transition_batch(self, f):
+        return self.transition(f)
         
     
 class CatmullRomSpline(Transition):
@@ -37,5 +43,8 @@ class CatmullRomSpline(Transition):
     def transition(self, f):
         return self.catmull_rom_spline(f, self.p0, 0, 1, self.p3);
 
+    def transition_batch(self, f):
+        return self.transition(f)
+
     def catmull_rom_spline(self, t, p0, p1, p2, p3):
         return 0.5 * ((2 * p1) + (-p0 + p2) * t + (2 * p0 - 5 * p1 + 4 * p2 - p3) * t * t + (-p0 + 3 * p1 - 3 * p2 + p3) * t * t * t)
\ No newline at end of file